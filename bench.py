@@ -0,0 +1,236 @@
+# fmt: off
+import argparse
+import json
+from math import sqrt
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+os.environ.setdefault('SDL_VIDEODRIVER', "dummy")
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import pygame as pg
+
+from cutcache import CutCache
+from jigsaw import Renderer
+from puzzle import Puzzle
+# fmt: on
+
+
+SCENARIOS = ("subsurface", "pan", "drag", "drag_group")
+PERCENTILES = (50, 90, 99)
+
+
+def synthetic_image(w, h, seed=0):
+    # smooth gradients plus noise, so neither scaling nor compression gets a free ride
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    pixels = np.stack([127 + 127 * np.sin(x / 97 + y / 151),
+                       127 + 127 * np.cos(x / 53 - y / 71),
+                       255 * (x + y) / (w + h)], axis=-1)
+    pixels += rng.normal(0, 16, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def dimensions(pieces, ratio):
+    height = max(2, int(sqrt(pieces / ratio) + 0.5))
+    width = max(2, int(ratio * height + 0.5))
+    return width, height
+
+
+def build(img, width, height, cache, args):
+    t = time.perf_counter()
+    puzzle = Puzzle(img, width, height, workers=args.jobs, cache=cache, atlas=args.atlas,
+                    lazy=args.lazy, seed=1)
+    return puzzle, time.perf_counter() - t
+
+
+def make_group(puzzle, side):
+    # connects a side x side block of pieces away from the image, like a half-built corner
+    block = [puzzle.matrix[(r, c)] for r in range(1, side + 1) for c in range(1, side + 1)]
+    x0, y0 = block[0].x, block[0].y
+    for p in block:
+        puzzle.place_piece(p, x0 + (p.col - 1) * puzzle.piece_w, y0 + (p.row - 1) * puzzle.piece_h)
+        puzzle.connection_check(p)
+    return block[0]
+
+
+def frames(puzzle, scenario, screen, scale, count):
+    sw, sh = screen.get_size()
+    renderer = Renderer(puzzle, None)
+    target = puzzle.matrix[(puzzle.height // 2, puzzle.width // 2)]
+    if scenario == "drag_group":
+        target = make_group(puzzle, max(2, min(puzzle.width, puzzle.height) // 4))
+    pan_x = target.sx() - sw / scale / 2
+    pan_y = target.sy() - sh / scale / 2
+    renderer.render(screen, pan_x, pan_y, scale)
+
+    for i in range(count):
+        # back and forth, so long runs stay over the same part of the board
+        step = 1 if i // 60 % 2 == 0 else -1
+        if scenario == "subsurface":
+            yield lambda: puzzle.subsurface(pan_x, pan_y, sw / scale, sh / scale, scale)
+        elif scenario == "pan":
+            pan_x += step * 8 / scale
+            pan_y += step * 5 / scale
+            yield lambda: renderer.render(screen, pan_x, pan_y, scale)
+        else:
+            def drag(step=step):
+                puzzle.move_piece(target, step * 4 / scale, step * 3 / scale)
+                renderer.render(screen, pan_x, pan_y, scale)
+            yield drag
+
+
+def percentile(times, p):
+    return float(np.percentile(times, p) * 1000)
+
+
+def run_case(puzzle, zoom, scenario, args):
+    screen = pg.display.set_mode(args.screen)
+    fit = min(args.screen[0] / puzzle.w, args.screen[1] / puzzle.h)
+    scale = fit * zoom
+
+    for frame in frames(puzzle, scenario, screen, scale, args.warmup):
+        frame()
+    times = []
+    for frame in frames(puzzle, scenario, screen, scale, args.frames):
+        t = time.perf_counter()
+        frame()
+        times.append(time.perf_counter() - t)
+
+    # a shorter second pass under tracemalloc, which would otherwise skew the timings. it only
+    # sees Python allocations, pixel buffers made by SDL don't show up
+    tracemalloc.start()
+    allocs = []
+    for frame in frames(puzzle, scenario, screen, scale, args.alloc_frames):
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        frame()
+        after, peak = tracemalloc.get_traced_memory()
+        allocs.append((peak - before, after - before))
+    tracemalloc.stop()
+    allocs = np.array(allocs or [(0, 0)]) / 1024
+
+    times = np.array(times)
+    result = {
+        "pieces": puzzle.width * puzzle.height,
+        "dimensions": [puzzle.width, puzzle.height],
+        "zoom": zoom,
+        "scale": scale,
+        "scenario": scenario,
+        "frames": len(times),
+        "mean_ms": float(times.mean() * 1000),
+        "max_ms": float(times.max() * 1000),
+        "py_alloc_peak_kb": float(allocs[:, 0].max()),
+        "py_alloc_mean_kb": float(allocs[:, 0].mean()),
+        "py_retained_kb": float(allocs[:, 1].sum()),
+    }
+    for p in PERCENTILES:
+        result[f"p{p}_ms"] = percentile(times, p)
+    return result
+
+
+def case_key(result):
+    return (result["pieces"], result["zoom"], result["scenario"])
+
+
+def compare(old_path, results):
+    with open(old_path) as f:
+        old = {case_key(r): r for r in json.load(f)["results"]}
+    print(f"{'pieces':>7} {'zoom':>5} {'scenario':<11} {'p50 old':>9} {'p50 new':>9} "
+          f"{'p99 old':>9} {'p99 new':>9} {'change':>7}", file=sys.stderr)
+    for r in results:
+        o = old.get(case_key(r))
+        if o is None:
+            continue
+        change = (r["p50_ms"] / o["p50_ms"] - 1) * 100 if o["p50_ms"] else 0
+        print(f"{r['pieces']:>7} {r['zoom']:>5} {r['scenario']:<11} {o['p50_ms']:>9.2f} "
+              f"{r['p50_ms']:>9.2f} {o['p99_ms']:>9.2f} {r['p99_ms']:>9.2f} {change:>+6.0f}%",
+              file=sys.stderr)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
+Benchmark puzzle rendering without a display.
+Results are written as JSON, one entry per piece count, zoom and scenario.
+
+    Run the default suite:
+
+        python3 bench.py -o bench_output.txt
+
+    Compare against an earlier run:
+
+        python3 bench.py --pieces 1000 --compare bench_output.txt""")
+
+    parser.add_argument('--pieces', help="Piece counts to benchmark",
+                        nargs='+', type=int, default=[100, 1000, 5000, 20000])
+    parser.add_argument('--zooms', help="Zoom levels relative to fitting the whole board on screen",
+                        nargs='+', type=float, default=[1, 4, 16])
+    parser.add_argument('--scenarios', help="Scenarios to run",
+                        nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--frames', help="Timed frames per case",
+                        type=int, default=120)
+    parser.add_argument('--warmup', help="Untimed frames per case before timing",
+                        type=int, default=30)
+    parser.add_argument('--alloc-frames', help="Frames per case traced for allocations",
+                        type=int, default=10)
+    parser.add_argument('--piece-size', help="Approximate piece size of the synthetic images",
+                        metavar='PIXELS', type=int, default=32)
+    parser.add_argument('--screen', help="Screen size to render to",
+                        nargs=2, metavar=('WIDTH', 'HEIGHT'), type=int, default=[1500, 1000])
+    parser.add_argument('-j', '--jobs', help="Processes to cut the puzzle with (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument('--atlas', help="Pack piece sprites into a few large texture atlases",
+                        action='store_true', default=False)
+    parser.add_argument('--lazy', help="Cut pieces as they come into view instead of up front",
+                        action='store_true', default=False)
+    parser.add_argument('-o', '--output', help="Write the results here instead of stdout",
+                        metavar='FILE', default=None)
+    parser.add_argument('--compare', help="Print p50/p99 changes against an earlier output",
+                        metavar='FILE', default=None)
+    args = parser.parse_args(argv)
+
+    pg.display.init()
+    pg.display.set_mode(args.screen)
+    results = []
+    for pieces in args.pieces:
+        width, height = dimensions(pieces, 3 / 2)
+        img = synthetic_image(width * args.piece_size, height * args.piece_size)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            # every case starts from a fresh layout, only the first one pays for the cut
+            cache = None if args.lazy else CutCache(cache_dir)
+            _, build_time = build(img, width, height, cache, args)
+            for zoom in args.zooms:
+                for scenario in args.scenarios:
+                    puzzle, _ = build(img, width, height, cache, args)
+                    result = run_case(puzzle, zoom, scenario, args)
+                    result["build_s"] = build_time
+                    print(f"{result['pieces']} pieces, zoom {zoom}, {scenario}: "
+                          f"p50 {result['p50_ms']:.2f}ms p99 {result['p99_ms']:.2f}ms",
+                          file=sys.stderr)
+                    results.append(result)
+
+    report = {
+        "python": platform.python_version(),
+        "pygame": pg.version.ver,
+        "sdl_video_driver": os.environ['SDL_VIDEODRIVER'],
+        "screen": args.screen,
+        "results": results,
+    }
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        compare(args.compare, results)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
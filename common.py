@@ -13,13 +13,33 @@ BLACK = (0, 0, 0)
 
 REQ_LEN = len("a".encode())
 
+# after a hello, an image request carries the offset to start sending from, and the response is
+# followed by the stream's sha256 digest, which a joining client finds its cached cut by, then the
+# image stream from that offset on, so an interrupted download can resume
 IMG_REQ = "g".encode()
+IMG_REQ_FMT = ">I"
+IMG_REQ_LEN = len(struct.pack(IMG_REQ_FMT, 1))
 IMG_FMT = ">III"
 IMG_RES_LEN = len(struct.pack(IMG_FMT, 1, 2, 3))
+IMG_DIGEST_LEN = 32
+
+# the stream is the image's width and height, then the image in horizontal bands from the top
+# down, each a (y, length) header and an encoded image, so that a client can start on the top of
+# the puzzle before the bottom has arrived
+IMG_INFO_FMT = ">II"
+IMG_INFO_LEN = len(struct.pack(IMG_INFO_FMT, 1, 2))
+BAND_FMT = ">II"
+BAND_HEADER_LEN = len(struct.pack(BAND_FMT, 1, 2))
 
 INIT_REQ = "i".encode()
-INIT_FMT = ">I"
-INIT_RES_LEN = len(struct.pack(INIT_FMT, 1))
+INIT_FMT = ">II"
+INIT_RES_LEN = len(struct.pack(INIT_FMT, 1, 2))
+# clients without a hello get a move count instead, then a move placing each piece
+LEGACY_INIT_FMT = ">I"
+
+# row, col, x, y of a piece that has moved since the initial layout
+SNAPSHOT_FMT = ">IIdd"
+SNAPSHOT_LEN = len(struct.pack(SNAPSHOT_FMT, 1, 2, 3, 4))
 
 UPDATE_REQ = "u".encode()
 UPDATE_FMT = ">II"
@@ -33,9 +53,39 @@ IDX_REQ = "d".encode()
 IDX_FMT = ">I"
 IDX_LEN = len(struct.pack(IDX_FMT, 1))
 
+CURSOR_REQ = "c".encode()
 CURSOR_FMT = ">IddiiddBBB"
 CURSOR_LEN = len(struct.pack(CURSOR_FMT, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9))
 
+# after subscribing, the server pushes a frame of moves, cursors and departed cursors' idx
+# whenever anything changed
+SUBSCRIBE_REQ = "s".encode()
+TICK_INTERVAL = 1 / 30
+
+# clients that open with a hello agree on a protocol version, anything else is the released
+# client's version 0, which polls with UPDATE_REQ. everything after subscribing travels in
+# length-prefixed frames of records, each a record type byte followed by that type's fixed-size body
+PROTOCOL_VERSION = 3
+HELLO_REQ = "h".encode()
+HELLO_FMT = ">I"
+HELLO_LEN = len(struct.pack(HELLO_FMT, 1))
+
+FRAME_FMT = ">I"
+FRAME_HEADER_LEN = len(struct.pack(FRAME_FMT, 1))
+MAX_FRAME_LEN = 1 << 24
+
+FULL_REC = "f".encode()
+GONE_REC = "x".encode()
+RECORD_LENS = {MOVE_REQ: MOVE_LEN, CURSOR_REQ: CURSOR_LEN, GONE_REC: IDX_LEN, FULL_REC: 0}
+
+
+def pack_img_req(offset):
+    return struct.pack(IMG_REQ_FMT, offset)
+
+
+def unpack_img_req(msg):
+    return struct.unpack(IMG_REQ_FMT, msg)
+
 
 def pack_img_res(img_size, w, h):
     return struct.pack(IMG_FMT, img_size, w, h)
@@ -45,14 +95,42 @@ def unpack_img_res(msg):
     return struct.unpack(IMG_FMT, msg)
 
 
-def pack_init_res(move_count):
-    return struct.pack(INIT_FMT, move_count)
+def pack_img_info(w, h):
+    return struct.pack(IMG_INFO_FMT, w, h)
+
+
+def unpack_img_info(msg):
+    return struct.unpack(IMG_INFO_FMT, msg)
+
+
+def pack_band(y, length):
+    return struct.pack(BAND_FMT, y, length)
+
+
+def unpack_band(msg):
+    return struct.unpack(BAND_FMT, msg)
+
+
+def pack_init_res(seed, snapshot_count):
+    return struct.pack(INIT_FMT, seed, snapshot_count)
 
 
 def unpack_init_res(msg):
     return struct.unpack(INIT_FMT, msg)
 
 
+def pack_legacy_init_res(move_count):
+    return struct.pack(LEGACY_INIT_FMT, move_count)
+
+
+def pack_snapshot(r, c, x, y):
+    return struct.pack(SNAPSHOT_FMT, r, c, x, y)
+
+
+def unpack_snapshot(msg):
+    return struct.unpack(SNAPSHOT_FMT, msg)
+
+
 def pack_update_res(move_count, cursor_count):
     return struct.pack(UPDATE_FMT, move_count, cursor_count)
 
@@ -61,6 +139,32 @@ def unpack_update_res(msg):
     return struct.unpack(UPDATE_FMT, msg)
 
 
+def pack_hello(version):
+    return struct.pack(HELLO_FMT, version)
+
+
+def unpack_hello(msg):
+    return struct.unpack(HELLO_FMT, msg)
+
+
+def pack_frame(records):
+    payload = b"".join(records)
+    return struct.pack(FRAME_FMT, len(payload)) + payload
+
+
+def unpack_records(payload):
+    i = 0
+    while i < len(payload):
+        kind = payload[i:i + 1]
+        if kind not in RECORD_LENS:
+            raise ValueError("unknown record type: " + str(kind))
+        end = i + 1 + RECORD_LENS[kind]
+        if end > len(payload):
+            raise ValueError("truncated record")
+        yield kind, payload[i + 1:end]
+        i = end
+
+
 def pack_idx(idx):
     return struct.pack(IDX_FMT, idx)
 
@@ -109,3 +213,52 @@ class Cursor():
     @classmethod
     def unpack(self, string):
         return Cursor(*struct.unpack(CURSOR_FMT, string))
+
+
+class FrameReader():
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        self.buf += data
+
+    def frames(self):
+        # complete frame payloads received so far, a partial one stays buffered for the next feed
+        while len(self.buf) >= FRAME_HEADER_LEN:
+            size = struct.unpack(FRAME_FMT, self.buf[:FRAME_HEADER_LEN])[0]
+            if size > MAX_FRAME_LEN:
+                raise ValueError("frame too large: " + str(size))
+            end = FRAME_HEADER_LEN + size
+            if len(self.buf) < end:
+                break
+            payload = bytes(self.buf[FRAME_HEADER_LEN:end])
+            del self.buf[:end]
+            yield payload
+
+
+class BandReader():
+    def __init__(self):
+        self.buf = bytearray()
+        # stream bytes fed so far, which is where a resumed download picks up
+        self.received = 0
+        self.size = None
+
+    def feed(self, data):
+        self.buf += data
+        self.received += len(data)
+
+    def bands(self):
+        # (y, encoded band) for each band received in full, the image size is known from the first
+        if self.size is None:
+            if len(self.buf) < IMG_INFO_LEN:
+                return
+            self.size = unpack_img_info(self.buf[:IMG_INFO_LEN])
+            del self.buf[:IMG_INFO_LEN]
+        while len(self.buf) >= BAND_HEADER_LEN:
+            y, length = unpack_band(self.buf[:BAND_HEADER_LEN])
+            end = BAND_HEADER_LEN + length
+            if len(self.buf) < end:
+                break
+            band = bytes(self.buf[BAND_HEADER_LEN:end])
+            del self.buf[:end]
+            yield y, band
@@ -0,0 +1,125 @@
+import hashlib
+import os
+from os import path
+import uuid
+
+import numpy as np
+
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_MB = 2048
+
+# index columns: row, col, piece type, width, height, sprite offset, crop offset
+INDEX_COLS = 7
+
+
+def default_cache_dir():
+    if os.environ.get('LOCALAPPDATA'):
+        base = os.environ['LOCALAPPDATA']
+    elif os.environ.get('XDG_CACHE_HOME'):
+        base = os.environ['XDG_CACHE_HOME']
+    else:
+        base = path.join(path.expanduser('~'), '.cache')
+    return path.join(base, 'rompecabezas', 'cuts')
+
+
+def image_digest(img):
+    digest = hashlib.sha256()
+    digest.update(f"{img.mode} {img.size}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+class CutCache():
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_MB * 1024 * 1024):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, img, width, height, downscale, margin, digest=None):
+        # digest stands in for the image's own when the image isn't all there yet
+        if digest is None:
+            digest = image_digest(img)
+        params = f"v{CACHE_VERSION} {digest} {width} {height} {downscale} {margin}"
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def paths(self, key):
+        return (path.join(self.directory, key + ".index.npy"),
+                path.join(self.directory, key + ".pixels.npy"))
+
+    def load(self, key):
+        index_path, pixels_path = self.paths(key)
+        try:
+            index = np.load(index_path)
+            # copy-on-write so surfaces built over the map never write back to the cache
+            pixels = np.load(pixels_path, mmap_mode='c')
+        except (OSError, ValueError):
+            return None
+        if index.ndim != 2 or index.shape[1] != INDEX_COLS:
+            return None
+
+        # loads count as uses for LRU eviction
+        os.utime(index_path)
+
+        cuts = []
+        for r, c, ptype, w, h, sprite_off, crop_off in index.tolist():
+            sprite = pixels[sprite_off:sprite_off + w * h * 4].reshape((h, w, 4))
+            crop = pixels[crop_off:crop_off + w * h * 3].reshape((h, w, 3))
+            cuts.append((r, c, ptype, (w, h), sprite, crop))
+        return cuts
+
+    def store(self, key, cuts):
+        if self.max_bytes <= 0:
+            return
+        index = np.zeros((len(cuts), INDEX_COLS), dtype=np.int64)
+        offset = 0
+        for i, (r, c, ptype, (w, h), sprite, crop) in enumerate(cuts):
+            index[i] = (r, c, ptype, w, h, offset, offset + w * h * 4)
+            offset += w * h * 7
+        if offset > self.max_bytes:
+            return
+
+        pixels = np.empty(offset, dtype=np.uint8)
+        for (r, c, ptype, (w, h), sprite, crop), row in zip(cuts, index):
+            pixels[row[5]:row[5] + w * h * 4] = np.asarray(sprite).reshape(-1)
+            pixels[row[6]:row[6] + w * h * 3] = np.asarray(crop).reshape(-1)
+
+        os.makedirs(self.directory, exist_ok=True)
+        index_path, pixels_path = self.paths(key)
+        # write both files under temporary names so a concurrent load never sees half an entry
+        tmp = "." + str(uuid.uuid4())
+        try:
+            np.save(pixels_path + tmp, pixels)
+            np.save(index_path + tmp, index)
+            os.replace(pixels_path + tmp + ".npy", pixels_path)
+            os.replace(index_path + tmp + ".npy", index_path)
+        except OSError:
+            for p in (pixels_path + tmp + ".npy", index_path + tmp + ".npy"):
+                if path.exists(p):
+                    os.remove(p)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".index.npy"):
+                continue
+            index_path, pixels_path = self.paths(name[:-len(".index.npy")])
+            try:
+                size = path.getsize(index_path) + path.getsize(pixels_path)
+                entries.append((path.getmtime(index_path), size, index_path, pixels_path))
+            except OSError:
+                continue
+            total += size
+
+        entries.sort()
+        for _, size, index_path, pixels_path in entries:
+            if total <= self.max_bytes:
+                break
+            for p in (index_path, pixels_path):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
@@ -1,9 +1,11 @@
 # fmt: off
 import argparse
+from collections import deque
+import io
 from math import sqrt
 import multiprocessing as mp
 import os
-import pickle
+import select
 import socket
 import struct
 import subprocess
@@ -15,45 +17,81 @@ from PIL import Image
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame as pg
 
-from common import (BG_COLOR, Cursor, CURSOR_LEN, IDX_LEN, IDX_REQ, IMG_RES_LEN, IMG_REQ,
-                    INIT_RES_LEN, INIT_REQ, Move, MOVE_LEN, MOVE_REQ, resource_path, unpack_idx,
-                    unpack_img_res, unpack_init_res, unpack_update_res, UPDATE_RES_LEN, UPDATE_REQ)
-from puzzle import Puzzle
+from common import (BandReader, Cursor, CURSOR_LEN, CURSOR_REQ, FrameReader, FULL_REC, GONE_REC,
+                    HELLO_LEN, HELLO_REQ, IDX_LEN, IDX_REQ, IMG_DIGEST_LEN, IMG_RES_LEN, IMG_REQ,
+                    INIT_RES_LEN, INIT_REQ, Move, MOVE_LEN, MOVE_REQ, pack_frame, pack_hello,
+                    pack_img_req, PROTOCOL_VERSION, resource_path, SNAPSHOT_LEN, SUBSCRIBE_REQ,
+                    TICK_INTERVAL, unpack_hello, unpack_idx, unpack_img_res, unpack_init_res,
+                    unpack_records, unpack_snapshot)
+from cutcache import CutCache, DEFAULT_CACHE_MB
+from profiler import FrameProfiler
+from puzzle import Puzzle, SCALE_CACHE_MB
 import server
+from sharedmem import CursorTable, Ring, SharedBlock
 # fmt: on
 
 
 viewer_process = None
 
+MAX_TINTED_CURSORS = 256
+# servers from before the hello skip it without a reply, and newer ones answer it straight away
+HELLO_TIMEOUT = 2
+DOWNLOAD_CHUNK = 1 << 16
+DOWNLOAD_RETRIES = 5
+IMAGE_FORMATS = ("PNG", "JPEG", "WEBP")
+MOVE_RING_LEN = 1 << 12
+
 
 class Moveplexer():
-    def __init__(self, sock, idx, cursors):
+    def __init__(self, sock, idx):
         self.sock = sock
-        self.incoming_moves = mp.Queue()
-        self.outgoing_moves = mp.Queue()
-        self.cursor = mp.Queue(1)
-        self.cursor.put(Cursor(idx).pack())
-        self.cursor_lock = mp.Lock()
-        self.proc = mp.Process(target=self.run, args=(sock, cursors,), daemon=True)
+        self.idx = idx
+        # everything between the game and the network process goes through shared memory, so a
+        # frame never pickles anything, waits on a lock or makes a round trip to another process
+        self.incoming_moves = Ring(MOVE_LEN, MOVE_RING_LEN)
+        self.outgoing_moves = Ring(MOVE_LEN, MOVE_RING_LEN)
+        # moves waiting for room in outgoing_moves
+        self.unsent_moves = deque()
+        self.cursor = Cursor(idx)
+        self.shared_cursor = SharedBlock(CURSOR_LEN)
+        self.shared_cursor.write([(0, self.cursor.pack())])
+        self.cursors = CursorTable()
+        # written to when a move is queued, so the network process sends it without waiting out
+        # its select
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_w.setblocking(False)
+        self.proc = mp.Process(target=self.run, args=(sock,), daemon=True)
 
     def send_move(self, piece):
-        self.outgoing_moves.put(Move(piece))
+        self.unsent_moves.append(Move(piece).pack())
+        self.flush_moves()
+
+    def flush_moves(self):
+        sent = False
+        while self.unsent_moves and self.outgoing_moves.put(self.unsent_moves[0]):
+            self.unsent_moves.popleft()
+            sent = True
+        if sent:
+            try:
+                self.wake_w.send(b"\0")
+            except BlockingIOError:
+                # plenty of wake ups already waiting
+                pass
 
     def get_move(self):
-        if self.incoming_moves.empty():
+        record = self.incoming_moves.get()
+        if record is None:
             return None
         else:
-            return self.incoming_moves.get()
+            return Move.unpack(record)
 
-    def init_puzzle(self, puzzle):
-        self.sock.sendall(INIT_REQ)
-        move_count = unpack_init_res(self.sock.recv(INIT_RES_LEN))[0]
-        for _ in range(move_count):
-            move = Move.unpack(self.sock.recv(MOVE_LEN))
-            p = puzzle.matrix[(move.r, move.c)]
-            puzzle.place_piece(p, move.x, move.y)
+    def init_puzzle(self, puzzle, init):
+        seed, positions = init
+        puzzle.scatter(seed)
+        puzzle.restore(positions)
 
     def update(self, puzzle, holding, cursor_pos):
+        self.flush_moves()
         move = self.get_move()
         while move is not None:
             p = puzzle.matrix[(move.r, move.c)]
@@ -63,54 +101,177 @@ class Moveplexer():
                 holding = None
             move = self.get_move()
 
-        with self.cursor_lock:
-            cursor = Cursor.unpack(self.cursor.get())
-            cursor.x, cursor.y = cursor_pos
-            if holding is None:
-                cursor.pr, cursor.pc = -1, -1
-            else:
-                cursor.pr, cursor.pc = holding.row, holding.col
-                cursor.px, cursor.py = holding.disp_x, holding.disp_y
-            self.cursor.put(cursor.pack())
+        cursor = self.cursor
+        cursor.x, cursor.y = cursor_pos
+        if holding is None:
+            cursor.pr, cursor.pc = -1, -1
+        else:
+            cursor.pr, cursor.pc = holding.row, holding.col
+            cursor.px, cursor.py = holding.disp_x, holding.disp_y
+        self.shared_cursor.write([(0, cursor.pack())])
 
         return holding
 
+    def remote_cursors(self):
+        return self.cursors.read()
+
     def start_process(self):
         self.proc.start()
 
-    def run(self, sock, cursors):
-        update_time = time.time()
-        update_interval = 1 / 30
+    def run(self, sock):
+        cursor_time = time.time()
+        sent_cursor = None
+        known = set()
+        reader = FrameReader()
         try:
+            # from here on the server pushes ticks, we only send what changed on our side
+            sock.sendall(SUBSCRIBE_REQ)
             while True:
-                while not self.outgoing_moves.empty():
-                    sock.sendall(MOVE_REQ)
-                    sock.sendall(self.outgoing_moves.get().pack())
+                records = []
+                move = self.outgoing_moves.get()
+                while move is not None:
+                    records.append(MOVE_REQ + move)
+                    move = self.outgoing_moves.get()
                 t = time.time()
-                if t >= update_time:
-                    update_time = t + update_interval
-                    sock.sendall(UPDATE_REQ)
-                    with self.cursor_lock:
-                        cursor = self.cursor.get()
-                        sock.sendall(cursor)
-                        self.cursor.put(cursor)
-
-                    new_move_count, cursor_count = unpack_update_res(sock.recv(UPDATE_RES_LEN))
-
-                    for _ in range(new_move_count):
-                        self.incoming_moves.put(Move.unpack(sock.recv(MOVE_LEN)))
-
-                    updated = set()
-                    for _ in range(cursor_count):
-                        c = Cursor.unpack(sock.recv(CURSOR_LEN))
-                        cursors[c.idx] = c
-                        updated.add(c.idx)
-                    for i in cursors.keys():
-                        if i not in updated:
-                            cursors.pop(i)
-        except struct.error:
+                if t >= cursor_time:
+                    cursor_time = t + TICK_INTERVAL
+                    _, cursor = self.shared_cursor.read()
+                    if cursor != sent_cursor:
+                        records.append(CURSOR_REQ + cursor)
+                        sent_cursor = cursor
+                if records:
+                    sock.sendall(pack_frame(records))
+
+                # wait for a tick or a move, but not past the next chance to send our cursor
+                ready, _, _ = select.select([sock, self.wake_r], [], [],
+                                            max(0, cursor_time - time.time()))
+                if self.wake_r in ready:
+                    self.wake_r.recv(1 << 12)
+                if sock not in ready:
+                    continue
+                data = sock.recv(1 << 16)
+                if not data:
+                    break
+                reader.feed(data)
+                for payload in reader.frames():
+                    known = self.apply_tick(unpack_records(payload), known)
+        except (struct.error, ValueError):
             pass
 
+    def apply_tick(self, records, known):
+        full = False
+        changed = {}
+        gone = set()
+        for kind, body in records:
+            if kind == FULL_REC:
+                full = True
+            elif kind == MOVE_REQ:
+                # the game empties the ring every frame, so a full one is never full for long
+                while not self.incoming_moves.put(body):
+                    time.sleep(0.001)
+            elif kind == CURSOR_REQ:
+                # a packed cursor starts with its idx
+                idx = unpack_idx(body[:IDX_LEN])[0]
+                if idx != self.idx:
+                    changed[idx] = body
+            elif kind == GONE_REC:
+                gone.add(unpack_idx(body)[0])
+        if full:
+            gone |= known - changed.keys()
+
+        self.cursors.update(changed, gone)
+        return (known | changed.keys()) - gone
+
+
+def merge_rects(rects):
+    # unions overlapping rects until none overlap, so nothing gets drawn twice
+    merged = []
+    for rect in rects:
+        rect = pg.Rect(rect)
+        i = 0
+        while i < len(merged):
+            if merged[i].colliderect(rect):
+                rect.union_ip(merged.pop(i))
+                i = 0
+            else:
+                i += 1
+        merged.append(rect)
+    return merged
+
+
+class Renderer():
+    def __init__(self, puzzle, cursor_img, profiler=None):
+        self.puzzle = puzzle
+        self.cursor_img = cursor_img
+        self.profiler = profiler
+        self.view = None
+        # cursor idx -> (screen rect, color) as last drawn
+        self.cursors = {}
+        # color -> cursor_img tinted that color
+        self.tinted = {}
+
+    def to_screen(self, rect, pan_x, pan_y, scale):
+        # padded by a pixel on each side to cover rounding in Puzzle.draw
+        x, y, w, h = rect
+        return pg.Rect(int((x - pan_x) * scale) - 1, int((y - pan_y) * scale) - 1,
+                       int(w * scale) + 3, int(h * scale) + 3)
+
+    def tinted_cursor(self, color):
+        img = self.tinted.get(color)
+        if img is None:
+            if len(self.tinted) >= MAX_TINTED_CURSORS:
+                self.tinted.clear()
+            img = self.tinted[color] = self.cursor_img.copy()
+            img.fill(color, special_flags=pg.BLEND_MIN)
+        return img
+
+    def render(self, screen, pan_x, pan_y, scale, cursors=(), extra=()):
+        # extra is screen rects to redraw regardless, like the spot under an overlay
+        sw, sh = screen.get_size()
+        screen_rect = screen.get_rect()
+        dirty = self.puzzle.take_dirty()
+
+        drawn = {}
+        for cursor in cursors:
+            if (
+                pan_x < cursor.x < pan_x + sw / scale and
+                pan_y < cursor.y < pan_y + sh / scale
+            ):
+                pos = (int((cursor.x - pan_x) * scale), int((cursor.y - pan_y) * scale))
+                drawn[cursor.idx] = (pg.Rect(pos, self.cursor_img.get_size()), cursor.color)
+
+        view = (pan_x, pan_y, scale, sw, sh)
+        if view != self.view:
+            self.view = view
+            rects = [screen_rect]
+        else:
+            rects = [self.to_screen(r, pan_x, pan_y, scale) for r in dirty]
+            rects += [pg.Rect(r) for r in extra if r is not None]
+            for idx in drawn.keys() | self.cursors.keys():
+                old, new = self.cursors.get(idx), drawn.get(idx)
+                if old != new:
+                    rects += [c[0] for c in (old, new) if c is not None]
+            rects = merge_rects([r.clip(screen_rect) for r in rects if r.colliderect(screen_rect)])
+            if sum(r.w * r.h for r in rects) > sw * sh / 2:
+                rects = [screen_rect]
+        self.cursors = drawn
+
+        for rect in rects:
+            self.puzzle.draw(screen, pan_x, pan_y, sw / scale, sh / scale, scale, rect)
+        if self.profiler is not None:
+            self.profiler.mark("board")
+
+        # cursors sit on top, redrawn only where the board under them was
+        for cursor_rect, color in drawn.values():
+            for i in cursor_rect.collidelistall(rects):
+                screen.set_clip(rects[i])
+                screen.blit(self.tinted_cursor(color), cursor_rect)
+        screen.set_clip(None)
+        if self.profiler is not None:
+            self.profiler.mark("cursors")
+
+        return rects
+
 
 def open_image_viewer(img):
     global viewer_process
@@ -127,6 +288,85 @@ def open_image_viewer(img):
             [image_viewer, filename], stdout=shutup, stderr=shutup, shell=shell)
 
 
+def connect(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    start_time = time.time()
+    while True:
+        if time.time() - start_time > 60:
+            print("Error: Could not connect to server")
+            sys.exit(1)
+        try:
+            sock.connect((host, port))
+            break
+        except Exception:
+            pass
+
+    sock.sendall(HELLO_REQ + pack_hello(PROTOCOL_VERSION))
+    sock.settimeout(HELLO_TIMEOUT)
+    try:
+        version = unpack_hello(sock.recv(HELLO_LEN, socket.MSG_WAITALL))[0]
+    except (socket.timeout, struct.error):
+        version = 0
+    if version < PROTOCOL_VERSION:
+        print("Error: Server is too old for this client")
+        sys.exit(1)
+    sock.settimeout(None)
+    return sock
+
+
+def read_init(sock):
+    seed, snapshot_count = unpack_init_res(sock.recv(INIT_RES_LEN, socket.MSG_WAITALL))
+    # where the room has got to so far, instead of replaying every move made before we joined
+    snapshot = sock.recv(snapshot_count * SNAPSHOT_LEN, socket.MSG_WAITALL)
+    return seed, [unpack_snapshot(snapshot[i:i + SNAPSHOT_LEN])
+                  for i in range(0, len(snapshot), SNAPSHOT_LEN)]
+
+
+def join_game(sock, args, cache):
+    # everything a joining client needs is asked for at once, and each row of pieces is cut as
+    # soon as its band of the image is in, so the cut keeps up with the download instead of
+    # waiting for it. the socket buffers whatever arrives while a band is being cut. a puzzle
+    # joined before is in the cut cache under the stream's digest, and isn't cut at all
+    reader = BandReader()
+    puzzle = None
+    retries = 0
+    while True:
+        try:
+            sock.sendall(IDX_REQ + IMG_REQ + pack_img_req(reader.received) + INIT_REQ)
+            idx = unpack_idx(sock.recv(IDX_LEN, socket.MSG_WAITALL))[0]
+            img_size, width, height = unpack_img_res(sock.recv(IMG_RES_LEN, socket.MSG_WAITALL))
+            img_digest = sock.recv(IMG_DIGEST_LEN, socket.MSG_WAITALL).hex()
+            percent = None
+            while reader.received < img_size:
+                chunk = sock.recv(min(DOWNLOAD_CHUNK, img_size - reader.received))
+                if not chunk:
+                    raise ConnectionError("Connection closed during download")
+                reader.feed(chunk)
+                for y, band in reader.bands():
+                    if puzzle is None:
+                        puzzle = Puzzle(Image.new('RGBA', reader.size), width, height,
+                                        cache=cache, atlas=args.atlas, lazy=True,
+                                        cut_ahead=False, scale_cache=args.scale_cache,
+                                        img_digest=img_digest)
+                    puzzle.add_band(y, Image.open(io.BytesIO(band)))
+                if reader.received * 100 // img_size != percent:
+                    percent = reader.received * 100 // img_size
+                    print(f"\rDownloading image... {percent}%", end="", flush=True)
+            init = read_init(sock)
+            break
+        except (OSError, struct.error) as exc:
+            retries += 1
+            if retries > DOWNLOAD_RETRIES:
+                print("\nError: Joining failed: " + str(exc))
+                sys.exit(1)
+            # a new connection picks up the download where this one left off
+            print("\nConnection lost, resuming...")
+            sock.close()
+            sock = connect(args.connect, int(args.port))
+    print()
+    return sock, idx, puzzle, init
+
+
 def main(argv):
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
 Do a jigsaw puzzle.
@@ -159,14 +399,32 @@ The port (default=7777) must be forwarded to host an online game.
                         metavar='IMAGE', default=False)
     parser.add_argument('-p', '--port', help="Port to connect to or host from",
                         default="7777")
+    parser.add_argument('--image-format', help="Re-encode the image sent to players when hosting",
+                        type=str.upper, choices=IMAGE_FORMATS, default=None)
     parser.add_argument('-d', '--dimensions', help="Specify puzzle dimensions (pieces)",
                         nargs=2, metavar=('WIDTH', 'HEIGHT'), type=int, default=False)
     parser.add_argument('-n', '--no-viewer', help="Don't open an accompanying image viewer",
                         action='store_true', default=False)
     parser.add_argument('-e', '--escape-exit', help="Let the escape key exit the program",
                         action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', help="Processes to cut the puzzle with (0 = one per core)",
+                        type=int, default=1)
+    parser.add_argument('--cache-size', help="Size limit of the on-disk cut cache (0 = disabled)",
+                        metavar='MB', type=int, default=DEFAULT_CACHE_MB)
+    parser.add_argument('--atlas', help="Pack piece sprites into a few large texture atlases",
+                        action='store_true', default=False)
+    parser.add_argument('--lazy', help="Cut pieces as they come into view instead of up front",
+                        action='store_true', default=False)
+    parser.add_argument('--scale-cache', help="Memory budget for scaled piece sprites",
+                        metavar='MB', type=int, default=SCALE_CACHE_MB)
+    parser.add_argument('--profile', help="Show frame rate and per-phase frame times on screen",
+                        action='store_true', default=False)
+    parser.add_argument('--profile-log', help="Log per-phase frame times to a .csv or .jsonl file",
+                        metavar='FILE', default=None)
     args = parser.parse_args(argv)
 
+    cache = CutCache(max_bytes=args.cache_size * 1024 * 1024) if args.cache_size > 0 else None
+
     if args.offline or args.server:
         if args.offline:
             img_path = args.offline
@@ -201,38 +459,16 @@ The port (default=7777) must be forwarded to host an online game.
         if args.server:
             print("Starting server...")
             server_proc = mp.Process(
-                target=server.run, args=(int(args.port), img_path, width, height), daemon=True)
+                target=server.run,
+                args=(int(args.port), img_path, width, height, args.image_format),
+                daemon=True)
             server_proc.start()
             args.connect = socket.gethostname()
         else:
             print("Connecting to server...")
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        start_time = time.time()
-        while True:
-            if time.time() - start_time > 60:
-                print("Error: Could not connect to server")
-                sys.exit(1)
-            try:
-                sock.connect((args.connect, int(args.port)))
-                break
-            except Exception:
-                pass
+        sock = connect(args.connect, int(args.port))
         print("Done.")
-
-        sock.sendall(IDX_REQ)
-        idx = unpack_idx(sock.recv(IDX_LEN))[0]
-
-        if not args.server:
-            print("Downloading image...")
-            sock.sendall(IMG_REQ)
-            img_size, width, height = unpack_img_res(sock.recv(IMG_RES_LEN))
-            img = pickle.loads(sock.recv(img_size, socket.MSG_WAITALL))
-            print("Done.")
-
-        manager = mp.Manager()
-        cursors = manager.dict()
-        moveplexer = Moveplexer(sock, idx, cursors)
     elif not args.offline:
         print("Error: A game mode argume is required [-o | -c | -s]")
         sys.exit()
@@ -245,9 +481,18 @@ The port (default=7777) must be forwarded to host an online game.
 
     display_flags = pg.RESIZABLE
     print("Building puzzle...")
-    puzzle = Puzzle(img, int(width), int(height))
+    if args.offline or args.server:
+        puzzle = Puzzle(img, int(width), int(height), workers=args.jobs, cache=cache,
+                        atlas=args.atlas, lazy=args.lazy, scale_cache=args.scale_cache)
+    if args.server:
+        sock.sendall(IDX_REQ + INIT_REQ)
+        idx = unpack_idx(sock.recv(IDX_LEN, socket.MSG_WAITALL))[0]
+        init = read_init(sock)
+    elif not args.offline:
+        sock, idx, puzzle, init = join_game(sock, args, cache)
     if not args.offline:
-        moveplexer.init_puzzle(puzzle)
+        moveplexer = Moveplexer(sock, idx)
+        moveplexer.init_puzzle(puzzle, init)
     print("Done.")
 
     if not args.no_viewer:
@@ -275,13 +520,22 @@ The port (default=7777) must be forwarded to host an online game.
     cursor_img = pg.image.load(resource_path('cursor.png'))
     cursor_img = pg.transform.scale(
         cursor_img, (int(cursor_img.get_width() / 2), int(cursor_img.get_height() / 2)))
+    cursor_img = cursor_img.convert_alpha()
+    profiler = None
+    if args.profile or args.profile_log:
+        profiler = FrameProfiler(args.profile_log, hud=args.profile)
+    renderer = Renderer(puzzle, cursor_img, profiler)
 
     if not args.offline:
         moveplexer.start_process()
     running = True
     while running:
+        if profiler is not None:
+            profiler.begin()
         if not args.offline:
             holding = moveplexer.update(puzzle, holding, cursor_pos)
+        if profiler is not None:
+            profiler.mark("moves")
 
         for event in pg.event.get():
             if event.type == pg.QUIT:
@@ -332,51 +586,35 @@ The port (default=7777) must be forwarded to host an online game.
                 elif holding is not None:
                     puzzle.move_piece(holding, mx, my)
 
-        ss_width = min(max(1, sw / scale), pw)
-        ss_height = min(max(1, sh / scale), ph)
-
-        if pan_x < 0:
-            ss_x = 0
-            blit_x = int(-pan_x * scale)
-        else:
-            ss_x = min(pan_x, pw)
-            blit_x = 0
-
-        if pan_y < 0:
-            ss_y = 0
-            blit_y = int(-pan_y * scale)
-        else:
-            ss_y = min(pan_y, ph)
-            blit_y = 0
-
-        if pan_x > pw - ss_width:
-            ss_width = max(pw - pan_x, 0)
-
-        if pan_y > ph - ss_height:
-            ss_height = max(ph - pan_y, 0)
-
-        screen.fill(BG_COLOR)
-        screen.blit(puzzle.subsurface(int(ss_x), int(ss_y), int(
-            ss_width), int(ss_height), scale), (blit_x, blit_y))
+        if profiler is not None:
+            profiler.mark("events")
 
+        remote_cursors = ()
         if not args.offline:
-            for cursor in cursors.values():
-                if (
-                    pan_x < cursor.x < pan_x + sw / scale and
-                    pan_y < cursor.y < pan_y + sh / scale
-                ):
-                    tinted_cursor_img = cursor_img.copy()
-                    tinted_cursor_img.fill(cursor.color, special_flags=pg.BLEND_MIN)
-                    screen.blit(tinted_cursor_img,
-                                (int((cursor.x - pan_x) * scale), int((cursor.y - pan_y) * scale)))
+            remote_cursors = moveplexer.remote_cursors()
+            for cursor in remote_cursors:
                 if cursor.pr != -1 and cursor.pc != -1:
                     p = puzzle.matrix[(cursor.pr, cursor.pc)]
                     if holding == p:
                         holding = None
                     dx, dy = cursor.px - p.disp_x, cursor.py - p.disp_y
-                    puzzle.move_piece(p, dx, dy)
-
-        pg.display.update()
+                    if dx != 0 or dy != 0:
+                        puzzle.move_piece(p, dx, dy)
+
+        if profiler is not None:
+            profiler.mark("remote")
+            rects = renderer.render(screen, pan_x, pan_y, scale, remote_cursors,
+                                    [profiler.hud_rect()])
+            hud_rect = profiler.draw(screen)
+            if hud_rect is not None:
+                rects.append(hud_rect)
+            profiler.mark("hud")
+        else:
+            rects = renderer.render(screen, pan_x, pan_y, scale, remote_cursors)
+        if rects:
+            pg.display.update(rects)
+        if profiler is not None:
+            profiler.mark("display")
 
         cursor_pos = (mouse_pos[0] / scale + pan_x, mouse_pos[1] / scale + pan_y)
 
@@ -384,7 +622,11 @@ The port (default=7777) must be forwarded to host an online game.
             pg.mixer.music.load(resource_path('congrats.wav'))
             pg.mixer.music.set_volume(1)
             pg.mixer.music.play(-1)
+        if profiler is not None:
+            profiler.end()
 
+    if profiler is not None:
+        profiler.close()
     pg.quit()
 
 
@@ -0,0 +1,93 @@
+from collections import deque
+import csv
+import json
+import os
+import time
+
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import pygame as pg
+
+from common import BLACK, WHITE
+
+
+HUD_WINDOW = 60
+HUD_INTERVAL = 0.25
+HUD_POS = (8, 8)
+
+
+class FrameProfiler():
+    def __init__(self, log_path=None, hud=True):
+        self.hud = hud
+        self.frame = 0
+        self.phases = {}
+        self.start = self.last = None
+        # (total, {phase: seconds}) for the last HUD_WINDOW frames
+        self.history = deque(maxlen=HUD_WINDOW)
+        self.font = None
+        self.text = None
+        self.text_time = 0
+
+        self.log = self.writer = None
+        if log_path is not None:
+            self.log = open(log_path, 'w', newline='')
+            self.jsonl = log_path.endswith(".jsonl")
+
+    def begin(self):
+        self.start = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        # charges the time since the previous mark (or begin) to phase
+        t = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + t - self.last
+        self.last = t
+
+    def end(self):
+        total = time.perf_counter() - self.start
+        self.history.append((total, self.phases))
+        if self.log is not None:
+            self.write(total)
+        self.frame += 1
+
+    def write(self, total):
+        row = {"frame": self.frame, "time": time.time(), "total_ms": total * 1000}
+        row.update((phase + "_ms", t * 1000) for phase, t in self.phases.items())
+        if self.jsonl:
+            self.log.write(json.dumps(row) + "\n")
+            return
+        if self.writer is None:
+            # phases are fixed by the main loop, so the first frame decides the columns
+            self.writer = csv.DictWriter(self.log, list(row), extrasaction='ignore')
+            self.writer.writeheader()
+        self.writer.writerow(row)
+
+    def hud_rect(self):
+        if not self.hud or self.text is None:
+            return None
+        return pg.Rect(HUD_POS, self.text.get_size())
+
+    def draw(self, screen):
+        if not self.hud or not self.history:
+            return None
+        t = time.perf_counter()
+        if self.text is None or t - self.text_time > HUD_INTERVAL:
+            self.text_time = t
+            if self.font is None:
+                self.font = pg.font.Font(None, 20)
+            frames = len(self.history)
+            total = sum(h[0] for h in self.history)
+            phases = {}
+            for _, frame_phases in self.history:
+                for phase, seconds in frame_phases.items():
+                    phases[phase] = phases.get(phase, 0) + seconds
+            line = f"{frames / total:.0f} fps  {total * 1000 / frames:.1f} ms"
+            for phase, seconds in phases.items():
+                line += f"  {phase} {seconds * 1000 / frames:.2f}"
+            self.text = self.font.render(line, True, WHITE, BLACK)
+        screen.blit(self.text, HUD_POS)
+        return self.hud_rect()
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
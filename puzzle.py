@@ -1,7 +1,12 @@
 # fmt: off
+from collections import OrderedDict
+import multiprocessing as mp
 import os
 import random
+import threading
 
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from PIL import Image
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame as pg
@@ -10,6 +15,18 @@ from common import BG_COLOR, BLACK, resource_path
 # fmt: on
 
 
+# pixels composited per vectorized batch, bounds the 16-bit scratch arrays to ~32MB
+BATCH_PIXELS = 1 << 22
+ATLAS_PAGE_SIZE = 4096
+CUT_AHEAD_BATCH = 64
+SCALE_CACHE_MB = 256
+MIN_MIP_SIZE = 4
+# for all cached locked layers together
+LOCKED_LAYER_MB = 128
+LOCKED_TILE = 512
+GROUP_SURFACE_MB = 32
+
+
 def rect_overlap(r1, r2):
     return (r1[0] < r2[0] + r2[2] and
             r1[0] + r1[2] > r2[0] and
@@ -37,18 +54,56 @@ class Piece():
     TRE = 15  # top right corner even
     BLE = 16  # bottom left corner even
 
-    def __init__(self, img, crop, ptype, row, col, x_ext, y_ext):
-        self.sprite = pg.image.fromstring(img.tobytes("raw", 'RGBA'), img.size, 'RGBA')
-        self.crop = pg.image.fromstring(crop.tobytes("raw", 'RGB'), crop.size, 'RGB')
-        self.w, self.h = img.size
+    def __init__(self, ptype, row, col, size, x_ext, y_ext):
+        # sprite and crop stay None until the piece is cut
+        self.sprite = None
+        self.crop = None
+        self.landlocked = False
+        self.w, self.h = size
         self.ptype = ptype
         self.row, self.col = row, col
         self.x_ext, self.y_ext = x_ext, y_ext
         self.x, self.y = 0, 0
+        self.group = Group(self)
         self.disp_x, self.disp_y = 0, 0
-        self.group = set([self])
         self.locked = False
-        self.adj = None
+        # neighboring pieces, and how many of them are not yet in this piece's group
+        self.adj = []
+        self.missing = 0
+        self.mips = None
+
+    def mip_level(self, size):
+        # the smallest level that is still at least the requested size, so the final scale only
+        # ever shrinks by less than half (or enlarges from the full sprite)
+        if self.mips is None:
+            self.mips = [self.sprite]
+        level = self.mips[0]
+        i = 0
+        while True:
+            w, h = level.get_size()
+            if w // 2 < max(size[0], MIN_MIP_SIZE) or h // 2 < max(size[1], MIN_MIP_SIZE):
+                return level
+            i += 1
+            if i == len(self.mips):
+                self.mips.append(pg.transform.smoothscale(level, (w // 2, h // 2)))
+            level = self.mips[i]
+
+    # where the piece is shown, the group's drag offset on top of where it was last indexed
+    @property
+    def disp_x(self):
+        return self.base_x + self.group.dx
+
+    @disp_x.setter
+    def disp_x(self, x):
+        self.base_x = x - self.group.dx
+
+    @property
+    def disp_y(self):
+        return self.base_y + self.group.dy
+
+    @disp_y.setter
+    def disp_y(self, y):
+        self.base_y = y - self.group.dy
 
     def spos(self):
         return (self.sx(), self.sy())
@@ -71,11 +126,451 @@ class Piece():
         self.disp_x, self.disp_y = self.x, self.y
 
 
+class Group():
+    # the pieces connected to each other, every member's group points at the same instance
+    def __init__(self, piece):
+        self.members = [piece]
+        # board rect around the members' sprites, None when it has to be recomputed
+        self.bounds = None
+        # how far the group has been dragged since its members were last indexed
+        self.dx, self.dy = 0, 0
+        # the z of the top member, the whole group is drawn at that height
+        self.z = 0
+
+    def __iter__(self):
+        return iter(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, piece):
+        return piece is not None and piece.group is self
+
+    def rect(self):
+        if self.bounds is None:
+            x0 = min(p.sx() for p in self.members)
+            y0 = min(p.sy() for p in self.members)
+            x1 = max(p.sx() + p.w for p in self.members)
+            y1 = max(p.sy() + p.h for p in self.members)
+            self.bounds = (x0, y0, x1 - x0, y1 - y0)
+        return self.bounds
+
+
+# piece type -> (base image, blur mask, transposes applied to both)
+TEMPLATES = {
+    Piece.TLC: ("corner.png", "corner_blur.png", ()),
+    Piece.TRC: ("corner.png", "corner_blur.png", (Image.FLIP_LEFT_RIGHT,)),
+    Piece.BLC: ("corner.png", "corner_blur.png", (Image.FLIP_TOP_BOTTOM,)),
+    Piece.BRE: ("corner.png", "corner_blur.png", (Image.ROTATE_180,)),
+    Piece.BRO: ("corner.png", "corner_blur.png", (Image.ROTATE_90, Image.FLIP_LEFT_RIGHT)),
+    Piece.BEE: ("even_edge.png", "even_edge_blur.png", (Image.FLIP_TOP_BOTTOM,)),
+    Piece.TEE: ("even_edge.png", "even_edge_blur.png", ()),
+    Piece.BOE: ("odd_edge.png", "odd_edge_blur.png", (Image.FLIP_TOP_BOTTOM,)),
+    Piece.TOE: ("odd_edge.png", "odd_edge_blur.png", ()),
+    Piece.ROE: ("odd_edge.png", "odd_edge_blur.png", (Image.ROTATE_270,)),
+    Piece.LOE: ("odd_edge.png", "odd_edge_blur.png", (Image.ROTATE_90,)),
+    Piece.REE: ("even_edge.png", "even_edge_blur.png", (Image.ROTATE_270,)),
+    Piece.LEE: ("even_edge.png", "even_edge_blur.png", (Image.ROTATE_90,)),
+    Piece.MID: ("middle.png", "middle_blur.png", ()),
+    Piece.MDR: ("middle.png", "middle_blur.png", (Image.ROTATE_90,)),
+    Piece.TRE: ("corner.png", "corner_blur.png", (Image.ROTATE_270,)),
+    Piece.BLE: ("corner.png", "corner_blur.png", (Image.ROTATE_90,)),
+}
+
+_template_images = {}
+
+
+def template_image(filename):
+    if filename not in _template_images:
+        img = Image.open(resource_path(filename))
+        img.load()
+        _template_images[filename] = img
+    return _template_images[filename]
+
+
+def template_size(filename):
+    return template_image(filename).size
+
+
+class TemplateCache():
+    def __init__(self):
+        self.oriented = {}
+        self.variants = {}
+
+    def orient(self, ptype):
+        if ptype not in self.oriented:
+            base_file, mask_file, transposes = TEMPLATES[ptype]
+            base, mask = template_image(base_file), template_image(mask_file)
+            for t in transposes:
+                base, mask = base.transpose(t), mask.transpose(t)
+            self.oriented[ptype] = (base, mask)
+        return self.oriented[ptype]
+
+    def get(self, ptype, size):
+        # returns the blend weights for Image.composite(crop, base, mask), split so that
+        # sprite = div255(crop * alpha + under) where under = base * (255 - alpha) + 128
+        key = (ptype, size)
+        if key not in self.variants:
+            base, mask = self.orient(ptype)
+            base = np.asarray(base.resize(size), dtype=np.uint16)
+            alpha = np.asarray(mask.resize(size), dtype=np.uint16)[..., 3:]
+            self.variants[key] = (alpha, base * (255 - alpha) + 128)
+        return self.variants[key]
+
+
+class Cutter():
+    def __init__(self, img, width, height, piece_w, piece_h, x_ext, y_ext):
+        self.img_w, self.img_h = img.size
+        self.width, self.height = width, height
+        self.piece_w, self.piece_h = piece_w, piece_h
+        self.x_ext, self.y_ext = x_ext, y_ext
+        self.templates = TemplateCache()
+        self.img = img
+        self.pixels = None
+        # zero padding stands in for the black fill PIL gives crops that leave the image
+        self.pad = int(max(x_ext, y_ext)) + 2
+
+    def load(self):
+        if self.pixels is None:
+            self.pixels = np.pad(np.asarray(self.img.convert('RGBA')),
+                                 ((self.pad, self.pad), (self.pad, self.pad), (0, 0)))
+
+    def paste(self, y, band):
+        # an image that arrives in bands fills in the padded pixels one band at a time
+        if self.pixels is None:
+            self.pixels = np.zeros((self.img_h + 2 * self.pad, self.img_w + 2 * self.pad, 4),
+                                   dtype=np.uint8)
+        arr = np.asarray(band.convert('RGBA'))
+        h, w = arr.shape[:2]
+        self.pixels[self.pad + y:self.pad + y + h, self.pad:self.pad + w] = arr
+
+    def row_bottom(self, r):
+        return max(y0 + h for _, _, y0, (_, h) in (self.crop_box(r, c) for c in range(self.width)))
+
+    def piece_box(self, r, c):
+        width, height = self.width, self.height
+        img_w, img_h = self.img_w, self.img_h
+        piece_w, piece_h = self.piece_w, self.piece_h
+        x_ext, y_ext = self.x_ext, self.y_ext
+        if r == 0 and c == 0:
+            # top left corner
+            return Piece.TLC, (0, 0, piece_w + x_ext, piece_h)
+        elif r == 0 and c == width - 1:
+            # top right corner
+            if width % 2 == 0:
+                return Piece.TRE, (img_w - piece_w, 0, img_w, piece_h + y_ext)
+            else:
+                return Piece.TRC, (img_w - piece_w - x_ext, 0, img_w, piece_h)
+        elif r == height - 1 and c == 0:
+            # bottom left corner
+            if height % 2 == 0:
+                return Piece.BLE, (0, img_h - piece_h - y_ext, piece_w, img_h)
+            else:
+                return Piece.BLC, (0, img_h - piece_h, piece_w + x_ext, img_h)
+        elif r == height - 1 and c == width - 1:
+            # bottom right corner
+            if width % 2 == height % 2:
+                return Piece.BRE, (img_w - piece_w - x_ext, img_h - piece_h, img_w, img_h)
+            else:
+                return Piece.BRO, (img_w - piece_w, img_h - piece_h - y_ext, img_w, img_h)
+        elif r == 0 or r == height - 1:
+            # horizontal edge
+            if bool(c % 2 == 0) ^ bool(height % 2 == 0 and r == height - 1):
+                if r == height - 1:
+                    # bottom edge
+                    return Piece.BEE, (c * piece_w - x_ext, img_h - piece_h,
+                                       (c + 1) * piece_w + x_ext, img_h)
+                else:
+                    # top edge
+                    return Piece.TEE, (c * piece_w - x_ext, 0, (c + 1) * piece_w + x_ext, piece_h)
+            else:
+                if r == height - 1:
+                    # bottom edge
+                    return Piece.BOE, (c * piece_w, img_h - piece_h - y_ext,
+                                       (c + 1) * piece_w, img_h)
+                else:
+                    # top edge
+                    return Piece.TOE, (c * piece_w, 0, (c + 1) * piece_w, piece_h + y_ext)
+        elif c == 0 or c == width - 1:
+            # vertical edge (switch odd and even edges)
+            if bool(r % 2 == 0) ^ bool(width % 2 == 0 and c == width - 1):
+                if c == width - 1:
+                    # right edge
+                    return Piece.ROE, (img_w - piece_w - x_ext, r * piece_h,
+                                       img_w, (r + 1) * piece_h)
+                else:
+                    # left edge
+                    return Piece.LOE, (0, r * piece_h, piece_w + x_ext, (r + 1) * piece_h)
+            else:
+                if c == width - 1:
+                    # right edge
+                    return Piece.REE, (img_w - piece_w, r * piece_h - y_ext,
+                                       img_w, (r + 1) * piece_h + y_ext)
+                else:
+                    # left edge
+                    return Piece.LEE, (0, r * piece_h - y_ext, piece_w, (r + 1) * piece_h + y_ext)
+        elif r % 2 == c % 2:
+            return Piece.MID, (c * piece_w - x_ext, r * piece_h,
+                               (c + 1) * piece_w + x_ext, (r + 1) * piece_h)
+        else:
+            return Piece.MDR, (c * piece_w, r * piece_h - y_ext,
+                               (c + 1) * piece_w, (r + 1) * piece_h + y_ext)
+
+    def crop_box(self, r, c):
+        ptype, box = self.piece_box(r, c)
+        x0, y0, x1, y1 = map(int, map(round, box))
+        return ptype, x0, y0, (x1 - x0, y1 - y0)
+
+    def composite(self, ptype, size, origins):
+        w, h = size
+        alpha, under = self.templates.get(ptype, size)
+        windows = sliding_window_view(self.pixels, (h, w, 4))
+        ys = np.array([y for x, y in origins]) + self.pad
+        xs = np.array([x for x, y in origins]) + self.pad
+        crops = windows[ys, xs, 0]
+        sprites = crops.astype(np.uint16)
+        sprites *= alpha
+        sprites += under
+        sprites += sprites >> 8
+        sprites >>= 8
+        return sprites.astype(np.uint8), np.ascontiguousarray(crops[..., :3])
+
+    def cut_rows(self, rows):
+        return self.cut_pieces([(r, c) for r in rows for c in range(self.width)])
+
+    def cut_pieces(self, keys):
+        self.load()
+        batches = {}
+        for r, c in keys:
+            ptype, x0, y0, size = self.crop_box(r, c)
+            batches.setdefault((ptype, size), []).append((r, c, x0, y0))
+
+        cuts = {}
+        for (ptype, (w, h)), pieces in batches.items():
+            step = max(1, BATCH_PIXELS // (w * h))
+            for i in range(0, len(pieces), step):
+                batch = pieces[i:i + step]
+                sprites, crops = self.composite(ptype, (w, h), [(x, y) for _, _, x, y in batch])
+                for (r, c, _, _), sprite, crop in zip(batch, sprites, crops):
+                    cuts[(r, c)] = (r, c, ptype, (w, h), sprite, crop)
+        return [cuts[key] for key in keys]
+
+
+class Atlas():
+    def __init__(self, sizes, page_size=ATLAS_PAGE_SIZE):
+        # shelf packing: fill rows left to right, start a new page when a page runs out of rows
+        self.slots = []
+        self.page_dims = []
+        x = y = shelf_h = 0
+        for w, h in sizes:
+            if x + w > page_size:
+                x, y, shelf_h = 0, y + shelf_h, 0
+            if not self.page_dims or y + h > page_size:
+                x, y, shelf_h = 0, 0, 0
+                self.page_dims.append([0, 0])
+            self.slots.append((len(self.page_dims) - 1, x, y))
+            dims = self.page_dims[-1]
+            dims[0], dims[1] = max(dims[0], x + w), max(dims[1], y + h)
+            x += w
+            shelf_h = max(shelf_h, h)
+        # mode -> (page arrays, page surfaces), allocated on first use
+        self.pages = {}
+        self.converted = {}
+
+    def region(self, mode, slot, arr):
+        if mode not in self.pages:
+            arrays = [np.zeros((h, w, len(mode)), dtype=np.uint8) for w, h in self.page_dims]
+            self.pages[mode] = (arrays, [pg.image.frombuffer(page, (w, h), mode)
+                                         for page, (w, h) in zip(arrays, self.page_dims)])
+        arrays, surfaces = self.pages[mode]
+        page, x, y = self.slots[slot]
+        h, w = arr.shape[:2]
+        arrays[page][y:y + h, x:x + w] = arr
+        # pieces cut after a page was converted are copied into the converted page, converting
+        # the whole page again would leave the old copy alive in every region handed out from it
+        converted = self.converted.get(surfaces[page])
+        if converted is not None:
+            converted.blit(surfaces[page], (x, y), (x, y, w, h))
+        return surfaces[page].subsurface((x, y, w, h))
+
+    def convert(self, region):
+        page = region.get_parent()
+        if page not in self.converted:
+            self.converted[page] = page.convert()
+        return self.converted[page].subsurface((region.get_offset(), region.get_size()))
+
+
+class SpatialGrid():
+    def __init__(self, cell_w, cell_h):
+        self.cell_w, self.cell_h = cell_w, cell_h
+        # (cell x, cell y) -> pieces whose bounds touch that cell
+        self.cells = {}
+        self.spans = {}
+
+    def span(self, x, y, w, h):
+        return (int(x // self.cell_w), int(y // self.cell_h),
+                int((x + w) // self.cell_w), int((y + h) // self.cell_h))
+
+    def update(self, piece):
+        # a pixel of slack covers hit rects that poke past a sprite rounded down when cropped
+        span = self.span(piece.sx() - 1, piece.sy() - 1, piece.w + 2, piece.h + 2)
+        if span == self.spans.get(piece):
+            return
+        self.remove(piece)
+        for cell in self.cells_in(span):
+            self.cells.setdefault(cell, set()).add(piece)
+        self.spans[piece] = span
+
+    def remove(self, piece):
+        span = self.spans.pop(piece, None)
+        if span is not None:
+            for cell in self.cells_in(span):
+                pieces = self.cells[cell]
+                pieces.discard(piece)
+                if not pieces:
+                    del self.cells[cell]
+
+    def cells_in(self, span):
+        x0, y0, x1, y1 = span
+        return [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+    def query(self, x, y, w, h):
+        x0, y0, x1, y1 = span = self.span(x, y, w, h)
+        found = set()
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # big areas (zoomed all the way out) are cheaper to answer from the occupied cells
+            for (cx, cy), pieces in self.cells.items():
+                if x0 <= cx <= x1 and y0 <= cy <= y1:
+                    found.update(pieces)
+        else:
+            for cell in self.cells_in(span):
+                found.update(self.cells.get(cell, ()))
+        return found
+
+
+class LockedLayer():
+    def __init__(self, size, scale):
+        self.surface = pg.Surface(size)
+        if pg.display.get_surface() is not None:
+            self.surface = self.surface.convert()
+        self.surface.fill(BLACK)
+        self.scale = scale
+        self.bytes = size[0] * size[1] * self.surface.get_bytesize()
+        # tiles of LOCKED_TILE pixels that are drawn, the rest wait until they come into view
+        self.filled = set()
+        # how far into Puzzle.locked_order and Puzzle.locked_changes this layer is drawn
+        self.count = 0
+        self.changes = 0
+
+    def tiles(self, rect):
+        rect = rect.clip(self.surface.get_rect())
+        if not rect:
+            return []
+        t = LOCKED_TILE
+        return [(tx, ty) for ty in range(rect.top // t, (rect.bottom - 1) // t + 1)
+                for tx in range(rect.left // t, (rect.right - 1) // t + 1)]
+
+    def tile_rect(self, tile):
+        rect = pg.Rect(tile[0] * LOCKED_TILE, tile[1] * LOCKED_TILE, LOCKED_TILE, LOCKED_TILE)
+        return rect.clip(self.surface.get_rect())
+
+
+class ScaleCache():
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        # (piece or group, scaled size) -> (scaled sprite, bytes), least recently used first. a
+        # size of None stands for the piece's mip chain below the full sprite, which lives in
+        # piece.mips
+        self.entries = OrderedDict()
+        self.sizes = {}
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def get(self, piece, size):
+        key = (piece, size)
+        sprite = self.lookup(key)
+        if sprite is not None:
+            return sprite
+
+        sprite = pg.transform.scale(self.mip_level(piece, size), size)
+        self.add(key, sprite, size[0] * size[1] * sprite.get_bytesize())
+        return sprite
+
+    def mip_level(self, piece, size):
+        key = (piece, None)
+        if key not in self.entries:
+            # a whole chain is at most a third of the sprite. one the budget can't hold would be
+            # rebuilt on every draw, so scaling from the sprite itself is cheaper
+            w, h = piece.sprite.get_size()
+            if w * h * piece.sprite.get_bytesize() // 3 > self.budget:
+                return piece.sprite
+        level = piece.mip_level(size)
+        cost = sum(m.get_width() * m.get_height() * m.get_bytesize() for m in piece.mips[1:])
+        if key in self.entries:
+            self.used -= self.entries.pop(key)[1]
+            self.sizes[piece].discard(None)
+        if cost and not self.add(key, None, cost):
+            # too big to keep around at all
+            piece.mips = None
+        return level
+
+    def add(self, key, sprite, cost):
+        if cost > self.budget:
+            return False
+        piece, size = key
+        self.entries[key] = (sprite, cost)
+        self.sizes.setdefault(piece, set()).add(size)
+        self.used += cost
+        while self.used > self.budget:
+            self.evict(*next(iter(self.entries)))
+        return True
+
+    def evict(self, piece, size):
+        self.used -= self.entries.pop((piece, size))[1]
+        if size is None:
+            piece.mips = None
+        sizes = self.sizes[piece]
+        sizes.discard(size)
+        if not sizes:
+            del self.sizes[piece]
+
+    def invalidate(self, piece):
+        piece.mips = None
+        self.discard(piece)
+
+    def discard(self, owner):
+        for size in list(self.sizes.get(owner, ())):
+            self.evict(owner, size)
+
+
+_worker_cutter = None
+
+
+def _init_cut_worker(cutter):
+    global _worker_cutter
+    _worker_cutter = cutter
+
+
+def _cut_rows(rows):
+    return _worker_cutter.cut_rows(rows)
+
+
 class Puzzle():
-    def __init__(self, img, width, height, downscale=-1, margin=2):
+    def __init__(self, img, width, height, downscale=-1, margin=2, workers=1, cache=None,
+                 atlas=False, lazy=False, seed=None, scale_cache=SCALE_CACHE_MB, cut_ahead=True,
+                 img_digest=None):
         if width <= 1 or height <= 1:
             raise ValueError("Puzzle dimensions must be greater than 1")
         img_w, img_h = img.size
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.key(img, width, height, downscale, margin, img_digest)
 
         if downscale > 0 and max(img.size) > downscale:
             if img_w > img_h:
@@ -90,267 +585,510 @@ class Puzzle():
         self.origin_x, self.origin_y = img_w * margin, img_h * margin
 
         piece_w, piece_h = img_w / width, img_h / height
-        base_mask = Image.open(resource_path("mask.png"))
-        base_mask_w, base_mask_h = base_mask.size
-        mask_xscale = piece_w / base_mask_w
-        mask_yscale = piece_h / base_mask_h
+        base_w, base_h = template_size("mask.png")
+        mask_xscale = piece_w / base_w
+        mask_yscale = piece_h / base_h
 
-        corner_mask = Image.open(resource_path("corner.png"))
-        ext = (corner_mask.size[0] - base_mask_w)
+        ext = template_size("corner.png")[0] - base_w
         x_ext = ext * mask_xscale
         y_ext = ext * mask_yscale
 
         self.width, self.height = width, height
         self.img, self.img_w, self.img_h = img, img_w, img_h
         self.piece_w, self.piece_h = piece_w, piece_h
+        self.x_ext, self.y_ext = x_ext, y_ext
         self.connect_tol = min(piece_w, piece_h) / 5
+        self.cutter = Cutter(img, width, height, piece_w, piece_h, x_ext, y_ext)
+        self.cut_lock = threading.Lock()
+        # the next row of pieces waiting on add_band for its pixels
+        self.band_row = 0
+        self.scaled = ScaleCache(scale_cache * 1024 * 1024)
+        # locked pieces never move again, so they live in their own grid and layers
+        self.grid = SpatialGrid(2 * (piece_w + 2 * x_ext), 2 * (piece_h + 2 * y_ext))
+        self.locked_grid = SpatialGrid(self.grid.cell_w, self.grid.cell_h)
+        self.locked_order = []
+        self.locked_changes = []
+        # (width, height) -> LockedLayer, least recently used first
+        self.layers = OrderedDict()
+        self.layer_bytes = 0
+        self.next_z = 0
+        # groups moved since their members were last indexed, see settle
+        self.dragging = set()
+        # board rects whose pixels changed since the last take_dirty
+        self.dirty = []
 
+        cuts = None
+        if cache is not None:
+            cuts = cache.load(cache_key)
+        if cuts is None and not lazy:
+            cuts = self.cut(workers)
+            if cache is not None:
+                cache.store(cache_key, cuts)
+
+        # in board order, which piece is on top is down to each piece's z
         self.pieces = []
         self.matrix = {}
         for r in range(height):
             for c in range(width):
-                if r == 0 and c == 0:
-                    # top left corner
-                    ptype = Piece.TLC
-                    base = Image.open(resource_path("corner.png"))
-                    mask = Image.open(resource_path("corner_blur.png"))
-                    crop = img.crop((0, 0, piece_w + x_ext, piece_h))
-                elif r == 0 and c == width - 1:
-                    # top right corner
-                    if width % 2 == 0:
-                        ptype = Piece.TRE
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.ROTATE_270)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.ROTATE_270)
-                        crop = img.crop((img_w - piece_w, 0, img_w, piece_h + y_ext))
-                    else:
-                        ptype = Piece.TRC
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.FLIP_LEFT_RIGHT)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.FLIP_LEFT_RIGHT)
-                        crop = img.crop((img_w - piece_w - x_ext, 0, img_w, piece_h))
-                elif r == height - 1 and c == 0:
-                    # bottom left corner
-                    if height % 2 == 0:
-                        ptype = Piece.BLE
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.ROTATE_90)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.ROTATE_90)
-                        crop = img.crop((0, img_h - piece_h - y_ext, piece_w, img_h))
-                    else:
-                        ptype = Piece.BLC
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.FLIP_TOP_BOTTOM)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
-                        crop = img.crop((0, img_h - piece_h, piece_w + x_ext, img_h))
-                elif r == height - 1 and c == width - 1:
-                    # bottom right corner
-                    if width % 2 == height % 2:
-                        ptype = Piece.BRE
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.ROTATE_180)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.ROTATE_180)
-                        crop = img.crop((img_w - piece_w - x_ext, img_h - piece_h, img_w, img_h))
-                    else:
-                        ptype = Piece.BRO
-                        base = Image.open(resource_path("corner.png"))
-                        base = base.transpose(Image.ROTATE_90).transpose(Image.FLIP_LEFT_RIGHT)
-                        mask = Image.open(resource_path("corner_blur.png"))
-                        mask = mask.transpose(Image.ROTATE_90).transpose(Image.FLIP_LEFT_RIGHT)
-                        crop = img.crop((img_w - piece_w, img_h - piece_h - y_ext, img_w, img_h))
-                elif r == 0 or r == height - 1:
-                    # horizontal edge
-                    if bool(c % 2 == 0) ^ bool(height % 2 == 0 and r == height - 1):
-                        base = Image.open(resource_path("even_edge.png"))
-                        mask = Image.open(resource_path("even_edge_blur.png"))
-                        if r == height - 1:
-                            # bottom edge
-                            ptype = Piece.BEE
-                            base = base.transpose(Image.FLIP_TOP_BOTTOM)
-                            mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
-                            crop = img.crop((c * piece_w - x_ext, img_h - piece_h,
-                                            (c + 1) * piece_w + x_ext, img_h))
-                        else:
-                            # top edge
-                            ptype = Piece.TEE
-                            crop = img.crop(
-                                (c * piece_w - x_ext, 0, (c + 1) * piece_w + x_ext, piece_h))
-                    else:
-                        base = Image.open(resource_path("odd_edge.png"))
-                        mask = Image.open(resource_path("odd_edge_blur.png"))
-                        if r == height - 1:
-                            # bottom edge
-                            ptype = Piece.BOE
-                            base = base.transpose(Image.FLIP_TOP_BOTTOM)
-                            mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
-                            crop = img.crop((c * piece_w, img_h - piece_h -
-                                            y_ext, (c + 1) * piece_w, img_h))
-                        else:
-                            # top edge
-                            ptype = Piece.TOE
-                            crop = img.crop((c * piece_w, 0, (c + 1) * piece_w, piece_h + y_ext))
-                elif c == 0 or c == width - 1:
-                    # vertical edge (switch odd and even edges)
-                    if bool(r % 2 == 0) ^ bool(width % 2 == 0 and c == width - 1):
-                        base = Image.open(resource_path("odd_edge.png"))
-                        mask = Image.open(resource_path("odd_edge_blur.png"))
-                        if c == width - 1:
-                            # right edge
-                            ptype = Piece.ROE
-                            base = base.transpose(Image.ROTATE_270)
-                            mask = mask.transpose(Image.ROTATE_270)
-                            crop = img.crop((img_w - piece_w - x_ext, r *
-                                            piece_h, img_w, (r + 1) * piece_h))
-                        else:
-                            # left edge
-                            ptype = Piece.LOE
-                            base = base.transpose(Image.ROTATE_90)
-                            mask = mask.transpose(Image.ROTATE_90)
-                            crop = img.crop((0, r * piece_h, piece_w + x_ext, (r + 1) * piece_h))
-                    else:
-                        base = Image.open(resource_path("even_edge.png"))
-                        mask = Image.open(resource_path("even_edge_blur.png"))
-                        if c == width - 1:
-                            # right edge
-                            ptype = Piece.REE
-                            base = base.transpose(Image.ROTATE_270)
-                            mask = mask.transpose(Image.ROTATE_270)
-                            crop = img.crop((img_w - piece_w, r * piece_h - y_ext,
-                                            img_w, (r + 1) * piece_h + y_ext))
-                        else:
-                            # left edge
-                            ptype = Piece.LEE
-                            base = base.transpose(Image.ROTATE_90)
-                            mask = mask.transpose(Image.ROTATE_90)
-                            crop = img.crop((0, r * piece_h - y_ext, piece_w,
-                                            (r + 1) * piece_h + y_ext))
-                elif r % 2 == c % 2:
-                    ptype = Piece.MID
-                    base = Image.open(resource_path("middle.png"))
-                    mask = Image.open(resource_path("middle_blur.png"))
-                    crop = img.crop((c * piece_w - x_ext, r * piece_h,
-                                    (c + 1) * piece_w + x_ext, (r + 1) * piece_h))
-                else:
-                    ptype = Piece.MDR
-                    base = Image.open(resource_path("middle.png"))
-                    base = base.transpose(Image.ROTATE_90)
-                    mask = Image.open(resource_path("middle_blur.png"))
-                    mask = mask.transpose(Image.ROTATE_90)
-                    crop = img.crop((c * piece_w, r * piece_h - y_ext,
-                                    (c + 1) * piece_w, (r + 1) * piece_h + y_ext))
-
-                base = base.resize(crop.size)
-                mask = mask.resize(crop.size)
-                piece = Piece(Image.composite(crop, base, mask), crop, ptype, r, c, x_ext, y_ext)
+                ptype, _, _, size = self.cutter.crop_box(r, c)
+                piece = Piece(ptype, r, c, size, x_ext, y_ext)
+                piece.z = piece.group.z = self.next_z
+                self.next_z += 1
                 self.pieces.append(piece)
                 self.matrix[(r, c)] = piece
+        for piece in self.pieces:
+            neighbors = [self.matrix.get((piece.row - 1, piece.col), None),
+                         self.matrix.get((piece.row + 1, piece.col), None),
+                         self.matrix.get((piece.row, piece.col - 1), None),
+                         self.matrix.get((piece.row, piece.col + 1), None)]
+            piece.adj = [n for n in neighbors if n is not None]
+            piece.missing = len(piece.adj)
 
-                if random.choice([True, False]):
-                    piece.x = random.choice(
-                        [random.randrange(int(img_w / 2), int(self.origin_x - piece.w)),
-                         random.randrange(int(self.origin_x + img_w + piece.x - piece.sx()),
-                                          int(self.w - img_w / 2))])
-                    piece.y = random.randrange(int(img_h / 2), int(self.h - img_h / 2))
-                else:
-                    piece.y = random.choice(
-                        [random.randrange(int(img_h / 2), int(self.origin_y - piece.h)),
-                         random.randrange(int(self.origin_y + img_h + piece.y - piece.sy()),
-                                          int(self.h - img_h / 2))])
-                    piece.x = random.randrange(int(img_w / 2), int(self.w - img_w / 2))
-                piece.place()
+        # sprites and crops share one packing, so a piece's regions line up in both atlases
+        self.atlas = Atlas([(p.w, p.h) for p in self.pieces]) if atlas else None
+
+        self.uncut = set()
+        if cuts is None:
+            self.uncut.update(self.pieces)
+        else:
+            self.apply_cuts(cuts)
+        self.scatter(seed)
+
+        if self.uncut:
+            self.viewport = None
+            self.ahead, self.ahead_viewport = [], None
+            self.cut_order, self.cut_pos = list(self.pieces), 0
+            self.cache, self.cache_key = cache, cache_key
+            # a complete lazy cut is still worth caching, so hold on to the arrays until then
+            self.lazy_cuts = [] if cache is not None else None
+            # without cutting ahead, pieces are only ever cut when drawn
+            if cut_ahead:
+                threading.Thread(target=self.cut_ahead, daemon=True).start()
+
+    def cut(self, workers=1):
+        if workers == 0:
+            workers = os.cpu_count() or 1
+        # a daemonic process, like the server's, isn't allowed children of its own
+        if workers <= 1 or mp.current_process().daemon:
+            return self.cutter.cut_rows(range(self.height))
+
+        # contiguous row chunks, a few per worker so uneven rows balance out
+        chunk_count = min(self.height, workers * 4)
+        chunks = [range(self.height * i // chunk_count, self.height * (i + 1) // chunk_count)
+                  for i in range(chunk_count)]
+        with mp.Pool(workers, initializer=_init_cut_worker, initargs=(self.cutter,)) as pool:
+            return [cut for rows in pool.map(_cut_rows, chunks) for cut in rows]
+
+    def apply_cuts(self, cuts):
+        for r, c, ptype, size, sprite, crop in cuts:
+            piece = self.matrix[(r, c)]
+            if self.atlas is None:
+                # the surfaces borrow the cut arrays' memory instead of copying it
+                piece.crop = pg.image.frombuffer(crop, size, 'RGB')
+                sprite = pg.image.frombuffer(sprite, size, 'RGBA')
+            else:
+                slot = r * self.width + c
+                piece.crop = self.atlas.region('RGB', slot, crop)
+                sprite = self.atlas.region('RGBA', slot, sprite)
+            piece.sprite = self.opaque_sprite(piece) if piece.landlocked else sprite
+            self.uncut.discard(piece)
+
+    def cut_now(self, pieces):
+        with self.cut_lock:
+            pieces = [p for p in pieces if p.sprite is None]
+            if pieces:
+                self.apply_lazy_cuts(pieces)
+
+    def apply_lazy_cuts(self, pieces):
+        cuts = self.cutter.cut_pieces([(p.row, p.col) for p in pieces])
+        self.apply_cuts(cuts)
+        if self.lazy_cuts is not None:
+            self.lazy_cuts.extend(cuts)
+            if not self.uncut:
+                self.cache.store(self.cache_key, self.lazy_cuts)
+                self.lazy_cuts = None
+
+    def next_cut_batch(self):
+        # pieces around the last viewport first, then everything else in board order
+        if not self.ahead and self.viewport != self.ahead_viewport:
+            self.ahead_viewport = x, y, w, h = self.viewport
+            area = (x - w, y - h, w * 3, h * 3)
+            self.ahead = [p for p in self.grid.query(*area) if p in self.uncut]
+        batch = []
+        while self.ahead and len(batch) < CUT_AHEAD_BATCH:
+            p = self.ahead.pop()
+            if p in self.uncut:
+                batch.append(p)
+        while self.cut_pos < len(self.cut_order) and len(batch) < CUT_AHEAD_BATCH:
+            p = self.cut_order[self.cut_pos]
+            self.cut_pos += 1
+            if p in self.uncut and p not in batch:
+                batch.append(p)
+        return batch
+
+    def cut_ahead(self):
+        while True:
+            with self.cut_lock:
+                batch = self.next_cut_batch()
+                if not batch:
+                    break
+                self.apply_lazy_cuts(batch)
+
+    def add_band(self, y, band):
+        # for an image that arrives from the top down, which a lazy puzzle can be built around
+        # before any of it is in: each row of pieces is cut as soon as its bottom edge arrives
+        self.img.paste(band, (0, y))
+        with self.cut_lock:
+            self.cutter.paste(y, band)
+        bottom = y + band.size[1]
+        pieces = []
+        while self.band_row < self.height and self.cutter.row_bottom(self.band_row) <= bottom:
+            pieces += [self.matrix[(self.band_row, c)] for c in range(self.width)]
+            self.band_row += 1
+        if pieces:
+            self.cut_now(pieces)
+
+    def opaque_sprite(self, piece):
+        if self.atlas is None:
+            return piece.crop.convert()
+        else:
+            return self.atlas.convert(piece.crop)
+
+    def scatter(self, seed=None):
+        # the same seed always produces the same layout, which is how online games sync it
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.seed = seed
+        rand = random.Random(seed)
+        img_w, img_h = self.img_w, self.img_h
+        # in row order, so the layout only depends on the seed and never on the stacking
+        for piece in self.matrix.values():
+            if rand.choice([True, False]):
+                piece.x = rand.choice(
+                    [rand.randrange(int(img_w / 2), int(self.origin_x - piece.w)),
+                     rand.randrange(int(self.origin_x + img_w + piece.x - piece.sx()),
+                                    int(self.w - img_w / 2))])
+                piece.y = rand.randrange(int(img_h / 2), int(self.h - img_h / 2))
+            else:
+                piece.y = rand.choice(
+                    [rand.randrange(int(img_h / 2), int(self.origin_y - piece.h)),
+                     rand.randrange(int(self.origin_y + img_h + piece.y - piece.sy()),
+                                    int(self.h - img_h / 2))])
+                piece.x = rand.randrange(int(img_w / 2), int(self.w - img_w / 2))
+            piece.place()
+            piece.group.bounds = None
+            self.grid.update(piece)
+
+    def restore(self, positions):
+        # (row, col, x, y) for every piece that has moved since the scatter, then the connections
+        # they make are rebuilt just like after a move
+        pieces = []
+        for r, c, x, y in positions:
+            p = self.matrix[(r, c)]
+            self.settle(p.group)
+            self.mark_dirty([p])
+            p.x, p.y = x, y
+            p.place()
+            p.group.bounds = None
+            self.grid.update(p)
+            self.raise_piece(p)
+            self.mark_dirty([p])
+            pieces.append(p)
+        for p in pieces:
+            self.connection_check(p)
+
+    def raise_piece(self, p):
+        p.z = p.group.z = self.next_z
+        self.next_z += 1
+
+    def visible(self, x, y, w, h, locked=False):
+        grid = self.locked_grid if locked else self.grid
+        # dragged groups are out of date in the grid, draw picks them up from self.dragging
+        pieces = [p for p in grid.query(x, y, w, h)
+                  if p.group not in self.dragging and
+                  rect_overlap((x, y, w, h), (p.sx(), p.sy(), p.w, p.h))]
+        pieces.sort(key=lambda p: p.z)
+        return pieces
 
     def click_check(self, x, y):
-        for i in range(len(self.pieces) - 1, -1, -1):
-            p = self.pieces[i]
+        for group in list(self.dragging):
+            self.settle(group)
+        top = None
+        for p in self.grid.query(x, y, 0, 0):
             if (not p.locked and
                 p.disp_x < x < p.disp_x + self.piece_w and
                     p.disp_y < y < p.disp_y + self.piece_h):
-                self.pieces.pop(i)
-                self.pieces.append(p)
-                return p
-        return None
+                if top is None or (p.group.z, p.z) > (top.group.z, top.z):
+                    top = p
+        if top is not None:
+            self.raise_piece(top)
+        return top
 
     def move_piece(self, piece, dx, dy):
         if piece.locked:
             return
-        for p in piece.group:
-            if p.sx() + dx < 0 or p.sx() + dx + p.w > self.w:
-                dx = 0
-            if p.sy() + dy < 0 or p.sy() + dy + p.h > self.h:
-                dy = 0
-            if dx == 0 and dy == 0:
-                break
-        for p in piece.group:
-            p.disp_x += dx
-            p.disp_y += dy
-            self.pieces.remove(p)
-            self.pieces.append(p)
+        group = piece.group
+        x, y, w, h = group.rect()
+        if x + dx < 0 or x + dx + w > self.w:
+            dx = 0
+        if y + dy < 0 or y + dy + h > self.h:
+            dy = 0
+        self.dirty.append((x, y, w, h))
+        # only the group's offset moves while dragging, its members catch up when it's dropped
+        group.dx += dx
+        group.dy += dy
+        group.z = self.next_z
+        self.next_z += 1
+        self.dragging.add(group)
+        group.bounds = (x + dx, y + dy, w, h)
+        self.dirty.append(group.bounds)
 
     def place_piece(self, piece, x, y):
         if piece.locked:
             return
         dx = x - piece.x
         dy = y - piece.y
-        for p in piece.group:
+        group = piece.group
+        self.dirty.append(group.rect())
+        self.dragging.discard(group)
+        group.dx, group.dy = 0, 0
+        for p in sorted(group, key=lambda p: p.z):
             p.x += dx
             p.y += dy
             p.place()
-            self.pieces.remove(p)
-            self.pieces.append(p)
+            self.grid.update(p)
+            self.raise_piece(p)
+        group.bounds = None
+        self.dirty.append(group.rect())
+
+    def settle(self, group):
+        # brings the members of a dragged group up to date in the grid without dropping it
+        if group not in self.dragging:
+            return
+        self.dragging.discard(group)
+        dx, dy = group.dx, group.dy
+        group.dx, group.dy = 0, 0
+        for p in group:
+            p.base_x += dx
+            p.base_y += dy
+            self.grid.update(p)
+
+    def mark_dirty(self, pieces):
+        x0 = y0 = float('inf')
+        x1 = y1 = float('-inf')
+        for p in pieces:
+            x0, y0 = min(x0, p.sx()), min(y0, p.sy())
+            x1, y1 = max(x1, p.sx() + p.w), max(y1, p.sy() + p.h)
+        self.dirty.append((x0, y0, x1 - x0, y1 - y0))
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, []
+        return dirty
 
     def subsurface(self, ss_x, ss_y, ss_width, ss_height, scale):
         scale_dims = (int(ss_width * scale), int(ss_height * scale))
         frame = pg.Surface(scale_dims, flags=pg.HWSURFACE)
-        frame.fill(BG_COLOR)
+        self.draw(frame, ss_x, ss_y, ss_width, ss_height, scale)
+        return frame
+
+    def draw(self, surface, ss_x, ss_y, ss_width, ss_height, scale, area=None):
+        # renders the board region (ss_x, ss_y, ss_width, ss_height) onto surface at scale,
+        # only touching the pixels inside area (a surface rect, all of it by default)
+        area = surface.get_rect() if area is None else pg.Rect(area)
+        clip = surface.get_clip()
+        surface.set_clip(area)
+        surface.fill(BG_COLOR, area)
         rx = max(self.origin_x, ss_x)
         ry = max(self.origin_y, ss_y)
         rw = min(self.origin_x + self.img_w, ss_x + ss_width) - rx
         rh = min(self.origin_y + self.img_h, ss_y + ss_height) - ry
         rx -= ss_x
         ry -= ss_y
-        if rw > 0 and rh > 0:
-            pg.draw.rect(frame, BLACK, (int(rx * scale), int(ry * scale),
+        # a couple of pixels of slack so rounding never drops a piece that reaches into area
+        slack = 2 / scale
+        view = (ss_x + area.x / scale - slack, ss_y + area.y / scale - slack,
+                area.w / scale + 2 * slack, area.h / scale + 2 * slack)
+        layer = self.locked_layer(scale, view)
+        if layer is not None:
+            surface.blit(layer.surface, (int((self.origin_x - ss_x) * scale),
+                                         int((self.origin_y - ss_y) * scale)))
+        elif rw > 0 and rh > 0:
+            pg.draw.rect(surface, BLACK, (int(rx * scale), int(ry * scale),
                          int(rw * scale), int(rh * scale)))
 
-        for p in self.pieces:
-            if not p.locked:
-                continue
-            if rect_overlap((ss_x, ss_y, ss_width, ss_height), (p.sx(), p.sy(), p.w, p.h)):
-                frame.blit(pg.transform.scale(p.sprite, (int(p.w * scale), int(p.h * scale))),
-                           (int((p.sx() - ss_x) * scale), int((p.sy() - ss_y) * scale)))
+        visible = self.visible(*view)
+        locked = [] if layer is not None else self.visible(*view, locked=True)
+        if self.uncut:
+            self.viewport = (ss_x, ss_y, ss_width, ss_height)
+            self.cut_now([p for p in locked + visible if p.sprite is None])
+
+        for p in locked:
+            self.draw_piece(surface, p, ss_x, ss_y, scale)
 
-        for p in self.pieces:
-            if p.locked:
+        # the rest go up a group at a time, at the height of each group's top member
+        groups = {}
+        for p in visible:
+            groups.setdefault(p.group, []).append(p)
+        for group in self.dragging:
+            if rect_overlap(view, group.rect()):
+                groups[group] = None
+        for group in sorted(groups, key=lambda g: g.z):
+            group_surface = self.group_surface(group, scale)
+            if group_surface is not None:
+                x, y, _, _ = group.rect()
+                surface.blit(group_surface, (int((x - ss_x) * scale), int((y - ss_y) * scale)))
                 continue
-            if rect_overlap((ss_x, ss_y, ss_width, ss_height), (p.sx(), p.sy(), p.w, p.h)):
-                frame.blit(pg.transform.scale(p.sprite, (int(p.w * scale), int(p.h * scale))),
-                           (int((p.sx() - ss_x) * scale), int((p.sy() - ss_y) * scale)))
+            pieces = groups[group]
+            if pieces is None:
+                pieces = [p for p in sorted(group, key=lambda p: p.z)
+                          if rect_overlap(view, (p.sx(), p.sy(), p.w, p.h))]
+                if self.uncut:
+                    self.cut_now([p for p in pieces if p.sprite is None])
+            for p in pieces:
+                self.draw_piece(surface, p, ss_x, ss_y, scale)
 
-        return frame
+        surface.set_clip(clip)
+
+    def draw_piece(self, surface, p, ss_x, ss_y, scale):
+        surface.blit(self.scaled.get(p, (int(p.w * scale), int(p.h * scale))),
+                     (int((p.sx() - ss_x) * scale), int((p.sy() - ss_y) * scale)))
+
+    def group_surface(self, group, scale):
+        # one blit per connected group, so dragging hundreds of pieces costs about as much as one.
+        # kept in the scale cache next to the sprites, so both share its budget
+        if len(group) < 2:
+            return None
+        x, y, w, h = group.rect()
+        size = (int(w * scale) + 2, int(h * scale) + 2)
+        key = (group, size)
+        group_surface = self.scaled.lookup(key)
+        if group_surface is not None:
+            return group_surface
+        cost = size[0] * size[1] * 4
+        if cost > min(GROUP_SURFACE_MB * 1024 * 1024, self.scaled.budget):
+            return None
+        if self.uncut:
+            self.cut_now([p for p in group if p.sprite is None])
+
+        group_surface = pg.Surface(size, pg.SRCALPHA)
+        for p in sorted(group, key=lambda p: p.z):
+            group_surface.blit(self.scaled.get(p, (int(p.w * scale), int(p.h * scale))),
+                               (int((p.sx() - x) * scale), int((p.sy() - y) * scale)))
+        self.scaled.add(key, group_surface, cost)
+        return group_surface
+
+    def locked_layer(self, scale, view):
+        # keyed by pixel size, so zooming back to a scale that drifted by a rounding error finds
+        # the layer it left behind
+        size = (int(self.img_w * scale), int(self.img_h * scale))
+        budget = LOCKED_LAYER_MB * 1024 * 1024
+        if not self.locked_order or size[0] * size[1] * 4 > budget:
+            return None
+        layer = self.layers.get(size)
+        if layer is None:
+            while self.layers and self.layer_bytes + size[0] * size[1] * 4 > budget:
+                self.layer_bytes -= self.layers.popitem(last=False)[1].bytes
+            layer = self.layers[size] = LockedLayer(size, scale)
+            layer.count = len(self.locked_order)
+            layer.changes = len(self.locked_changes)
+            self.layer_bytes += layer.bytes
+        else:
+            self.layers.move_to_end(size)
+
+        # newly locked pieces and landlock swaps only need repainting in tiles already drawn
+        changes = [(p.sx(), p.sy(), p.w, p.h) for p in self.locked_order[layer.count:]]
+        changes += self.locked_changes[layer.changes:]
+        layer.count = len(self.locked_order)
+        layer.changes = len(self.locked_changes)
+        for rect in changes:
+            rect = self.layer_rect(layer, *rect).inflate(2, 2)
+            for tile in layer.tiles(rect):
+                if tile in layer.filled:
+                    self.paint_locked(layer, rect.clip(layer.tile_rect(tile)))
+
+        for tile in layer.tiles(self.layer_rect(layer, *view)):
+            if tile not in layer.filled:
+                layer.filled.add(tile)
+                self.paint_locked(layer, layer.tile_rect(tile))
+        return layer
+
+    def layer_rect(self, layer, x, y, w, h):
+        s = layer.scale
+        return pg.Rect(int((x - self.origin_x) * s), int((y - self.origin_y) * s),
+                       int(w * s) + 1, int(h * s) + 1)
+
+    def paint_locked(self, layer, rect):
+        # the pieces reaching into rect, with a pixel of slack for rounding
+        s = layer.scale
+        pieces = self.visible((rect.x - 1) / s + self.origin_x, (rect.y - 1) / s + self.origin_y,
+                              (rect.w + 2) / s, (rect.h + 2) / s, locked=True)
+        if self.uncut:
+            self.cut_now([p for p in pieces if p.sprite is None])
+        layer.surface.set_clip(rect)
+        layer.surface.fill(BLACK)
+        for p in pieces:
+            size = (int(p.w * s), int(p.h * s))
+            layer.surface.blit(pg.transform.scale(self.scaled.mip_level(p, size), size),
+                               (int((p.sx() - self.origin_x) * s),
+                                int((p.sy() - self.origin_y) * s)))
+        layer.surface.set_clip(None)
+
+    def lock(self, piece):
+        if not piece.locked:
+            piece.locked = True
+            self.scaled.discard(piece.group)
+            self.grid.remove(piece)
+            self.locked_grid.update(piece)
+            self.locked_order.append(piece)
 
     def complete(self):
-        return len(self.pieces[0].group) == self.width * self.height
+        return len(self.matrix[(0, 0)].group) == self.width * self.height
+
+    def merge(self, a, b):
+        # relabel the smaller group, so a piece changes group at most log(pieces) times and
+        # only neighbors across the seam need their counts updated
+        if len(a) < len(b):
+            a, b = b, a
+        self.settle(a)
+        self.settle(b)
+        surrounded = []
+        for p in b:
+            for n in p.adj:
+                if n.group is a:
+                    p.missing -= 1
+                    n.missing -= 1
+                    if n.missing == 0:
+                        surrounded.append(n)
+            if p.missing == 0:
+                surrounded.append(p)
+        for p in b:
+            p.group = a
+        (ax, ay, aw, ah), (bx, by, bw, bh) = a.rect(), b.rect()
+        x, y = min(ax, bx), min(ay, by)
+        a.bounds = (x, y, max(ax + aw, bx + bw) - x, max(ay + ah, by + bh) - y)
+        a.z = max(a.z, b.z)
+        self.scaled.discard(a)
+        self.scaled.discard(b)
+        a.members.extend(b.members)
+        b.members = []
+        for p in surrounded:
+            self.landlock_check(p)
+        return a
 
     def landlock_check(self, piece):
-        if piece.adj is None:
-            piece.adj = set()
-            neighbors = [self.matrix.get((piece.row - 1, piece.col), None),
-                         self.matrix.get((piece.row + 1, piece.col), None),
-                         self.matrix.get((piece.row, piece.col - 1), None),
-                         self.matrix.get((piece.row, piece.col + 1), None)]
-            for n in neighbors:
-                if n is not None:
-                    piece.adj.add(n)
-        if piece.adj.issubset(piece.group):
-            piece.sprite = piece.crop.convert()
+        if not piece.landlocked and piece.missing == 0:
+            with self.cut_lock:
+                piece.landlocked = True
+                if piece.crop is not None:
+                    piece.sprite = self.opaque_sprite(piece)
+                    self.scaled.invalidate(piece)
+                    self.scaled.discard(piece.group)
+                    self.mark_dirty([piece])
+                    if piece.locked:
+                        self.locked_changes.append((piece.sx(), piece.sy(), piece.w, piece.h))
 
     def connection_check(self, piece):
-        for p in piece.group:
+        for p in list(piece.group):
             self.single_connection_check(p)
 
     def single_connection_check(self, piece):
@@ -364,12 +1102,10 @@ class Puzzle():
                     self.place_piece(other, other.x - dx, other.y - dy)
                 else:
                     self.place_piece(piece, tx, ty)
-                new_group = piece.group.union(other.group)
-                locked = piece.locked or other.locked
-                for p in new_group:
-                    p.group = new_group
-                    p.locked = locked
-                    self.landlock_check(p)
+                if piece.locked != other.locked:
+                    for p in (other.group if piece.locked else piece.group):
+                        self.lock(p)
+                self.merge(piece.group, other.group)
 
         n = self.matrix.get((piece.row - 1, piece.col), None)
         if n is not None and n not in piece.group:
@@ -391,7 +1127,7 @@ class Puzzle():
             if abs(dx) < self.connect_tol and abs(dy) < self.connect_tol:
                 self.place_piece(piece, piece.x + dx, piece.y + dy)
                 for p in piece.group:
-                    p.locked = True
+                    self.lock(p)
 
         if piece.row == 0:
             if piece.col == 0:
@@ -1,108 +1,326 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
+import io
 import pickle
-import select
-import socket
+import struct
+import time
 
 from PIL import Image
 
-from common import (Cursor, CURSOR_LEN, IDX_REQ, IMG_REQ, INIT_REQ, Move, MOVE_LEN, MOVE_REQ,
-                    pack_idx, pack_img_res, pack_init_res, pack_update_res, REQ_LEN, UPDATE_REQ)
+from common import (Cursor, CURSOR_LEN, CURSOR_REQ, FRAME_FMT, FRAME_HEADER_LEN, FULL_REC,
+                    GONE_REC, HELLO_LEN, HELLO_REQ, IDX_REQ, IMG_REQ, IMG_REQ_LEN, INIT_REQ,
+                    MAX_FRAME_LEN, Move, MOVE_LEN, MOVE_REQ, pack_band, pack_frame, pack_hello,
+                    pack_idx, pack_img_info, pack_img_res, pack_init_res, pack_legacy_init_res,
+                    pack_snapshot, pack_update_res, PROTOCOL_VERSION, REQ_LEN,
+                    SUBSCRIBE_REQ, TICK_INTERVAL, unpack_hello, unpack_img_req, unpack_records,
+                    UPDATE_REQ)
 from puzzle import Puzzle
 
 
-def run(port, img_path, W, H):
-    img = Image.open(img_path)
-    puzzle = Puzzle(img, int(W), int(H))
-    moves = []
-    initial_moves = []
-    for p in puzzle.pieces:
-        initial_moves.append(Move(p).pack())
+# a client's socket buffer may hold this much before its handler waits for it to drain
+WRITE_HIGH_WATER = 1 << 20
+# above this, updates skip the other cursors until the client catches up
+WRITE_DEGRADE = 1 << 16
+# a client that can't take any data for this long is dropped
+STALL_TIMEOUT = 30
+IMG_CHUNK = 1 << 18
+IMG_BAND_ROWS = 128
+IMG_QUALITY = 95
 
-    img_bytes = pickle.dumps(img)
-    img_res = pack_img_res(len(img_bytes), W, H)
 
-    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    lsock.bind(("0.0.0.0", port))
-    lsock.listen(32)
-    clients = {}
-    indices = {}
-    cursors = {}
+class Room():
+    def __init__(self, puzzle, img_bands, W, H):
+        # the room's puzzle is never drawn, it just follows every move so that it always holds
+        # the latest position of each piece
+        self.puzzle = puzzle
+        self.initial = {key: (p.x, p.y) for key, p in puzzle.matrix.items()}
+        # a future of the banded image stream clients download
+        self.img_bands = img_bands
+        self.img_digest = None
+        self.W = W
+        self.H = H
+        self.pickled_img = None
+        # moves from log position self.base on, older ones have reached every client
+        self.moves = []
+        self.base = 0
+        # client idx -> log position of the next move to send it
+        self.positions = {}
+        self.cursors = {}
+        self.next_idx = 0
+        # what changed since the last tick, and where in the log that tick ended
+        self.tick_pos = 0
+        self.changed = set()
+        self.gone = set()
+        # client idx -> Subscriber, for clients that get ticks pushed instead of polling
+        self.subscribers = {}
 
-    to_read = [lsock]
+    def end(self):
+        return self.base + len(self.moves)
 
-    def client_disconnect(sock):
-        cursors.pop(indices[sock])
-        to_read.remove(sock)
+    def image_digest(self):
+        if self.img_digest is None:
+            self.img_digest = hashlib.sha256(self.img_bands.result()).digest()
+        return self.img_digest
 
-    def try_recv(sock, size):
-        try:
-            return sock.recv(size)
-        except ConnectionResetError:
-            print("Server: Client disconnected.")
-            client_disconnect(sock)
-            return None
+    def legacy_image(self):
+        # clients without a hello unpickle the decoded image, only made once one of them asks
+        if self.pickled_img is None:
+            self.pickled_img = pickle.dumps(self.puzzle.img)
+        return self.pickled_img
 
-    def try_send(sock, data):
-        try:
-            sock.sendall(data)
-            return True
-        except ConnectionResetError:
-            print("Server: Client disconnected.")
-            client_disconnect(sock)
-            return False
+    def join(self, idx):
+        self.cursors[idx] = Cursor(idx).pack()
+        self.positions[idx] = self.end()
+        self.changed.add(idx)
+
+    def leave(self, idx):
+        self.cursors.pop(idx)
+        self.positions.pop(idx)
+        self.subscribers.pop(idx, None)
+        self.changed.discard(idx)
+        self.gone.add(idx)
+        self.compact()
+
+    def set_cursor(self, idx, packed):
+        if self.cursors[idx] != packed:
+            self.cursors[idx] = packed
+            self.changed.add(idx)
+
+    def frame(self, start, cursors, gone=(), full=False):
+        moves = self.moves[start - self.base:]
+        return pack_frame([FULL_REC] * full + [MOVE_REQ + m for m in moves] +
+                          [CURSOR_REQ + c for c in cursors] +
+                          [GONE_REC + pack_idx(i) for i in gone])
+
+    def subscribe(self, idx, writer):
+        # the whole cursor table up front, the moves it hasn't seen come with the next tick
+        self.subscribers[idx] = Subscriber(writer)
+        writer.write(self.frame(self.end(), list(self.cursors.values()), full=True))
+
+    def tick(self):
+        end = self.end()
+        cursors = [self.cursors[i] for i in self.changed]
+        gone = list(self.gone)
+        self.changed, self.gone = set(), set()
+
+        # encoded once for every subscriber that is up to date, which is nearly always all of them
+        changes = end > self.tick_pos or cursors or gone
+        shared = None
+        for idx, sub in list(self.subscribers.items()):
+            buffered = sub.writer.transport.get_write_buffer_size()
+            if sub.behind is None and buffered > WRITE_DEGRADE:
+                sub.behind = time.time()
+            if sub.behind is not None:
+                if buffered > WRITE_DEGRADE // 4:
+                    if time.time() - sub.behind > STALL_TIMEOUT:
+                        print("Server: Client stalled.")
+                        # its handler cleans up the rest once it sees the socket close
+                        del self.subscribers[idx]
+                        sub.writer.close()
+                    continue
+                # caught up again, it gets everything it skipped in one go
+                sub.behind = None
+                sub.writer.write(self.frame(self.positions[idx], list(self.cursors.values()),
+                                            full=True))
+            elif self.positions[idx] != self.tick_pos:
+                sub.writer.write(self.frame(self.positions[idx], cursors, gone))
+            elif changes:
+                if shared is None:
+                    shared = self.frame(self.tick_pos, cursors, gone)
+                sub.writer.write(shared)
+            self.positions[idx] = end
+        self.tick_pos = end
+        self.compact()
+
+    def move(self, packed):
+        self.moves.append(packed)
+        move = Move.unpack(packed)
+        p = self.puzzle.matrix[(move.r, move.c)]
+        self.puzzle.place_piece(p, move.x, move.y)
+        self.puzzle.connection_check(p)
+        # nothing ever redraws this puzzle
+        self.puzzle.take_dirty()
+
+    def snapshot(self):
+        return [pack_snapshot(r, c, p.x, p.y) for (r, c), p in self.puzzle.matrix.items()
+                if (p.x, p.y) != self.initial[(r, c)]]
+
+    def compact(self):
+        low = min(self.positions.values(), default=self.end())
+        if low > self.base:
+            del self.moves[:low - self.base]
+            self.base = low
+
+
+class Subscriber():
+    def __init__(self, writer):
+        self.writer = writer
+        # when the client fell too far behind to be sent ticks, None while it keeps up
+        self.behind = None
+
+
+async def send(writer, *chunks):
+    for data in chunks:
+        writer.write(data)
+    # only this client's handler waits, everyone else keeps being served. drain only blocks over
+    # the high water mark, and the timeout is too costly to set up for every small reply
+    if writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+        await asyncio.wait_for(writer.drain(), STALL_TIMEOUT)
+    else:
+        await writer.drain()
+
+
+async def send_image(writer, room, offset):
+    img_bands = await asyncio.wrap_future(room.img_bands)
+    await send(writer, pack_img_res(len(img_bands), room.W, room.H), room.image_digest())
+    # only this client's handler waits for the transfer
+    await asyncio.get_running_loop().sendfile(writer.transport, io.BytesIO(img_bands), offset)
 
+
+async def send_legacy_image(writer, room):
+    img_bytes = memoryview(room.legacy_image())
+    writer.write(pack_img_res(len(img_bytes), room.W, room.H))
+    for i in range(0, len(img_bytes), IMG_CHUNK):
+        await send(writer, img_bytes[i:i + IMG_CHUNK])
+
+
+async def read_frames(room, idx, reader):
     while True:
         try:
-            ready_to_read, ready_to_write, in_error = \
-                select.select(to_read, [], [])
-
-            for sock in ready_to_read:
-                if sock == lsock:
-                    csock, addr = sock.accept()
-                    clients[csock] = 0
-                    idx = len(indices)
-                    indices[csock] = idx
-                    cursors[idx] = Cursor(idx).pack()
-                    to_read.append(csock)
-                    print("Server: Client connected.")
-                    continue
+            header = await reader.readexactly(FRAME_HEADER_LEN)
+        except asyncio.IncompleteReadError as exc:
+            if not exc.partial:
+                return
+            raise
+        size = struct.unpack(FRAME_FMT, header)[0]
+        if size > MAX_FRAME_LEN:
+            raise ValueError("frame too large: " + str(size))
+        for kind, body in unpack_records(await reader.readexactly(size)):
+            if kind == MOVE_REQ:
+                room.move(body)
+            elif kind == CURSOR_REQ:
+                room.set_cursor(idx, body)
+            else:
+                raise ValueError("unexpected record type: " + str(kind))
 
-                req = try_recv(sock, REQ_LEN)
-                if req is None:
-                    continue
 
-                if req == IDX_REQ:
-                    try_send(sock, pack_idx(indices[sock]))
-                elif req == IMG_REQ:
-                    try_send(sock, img_res)
-                    try_send(sock, img_bytes)
-                elif req == INIT_REQ:
-                    try_send(sock, pack_init_res(len(initial_moves)))
-                    for m in initial_moves:
-                        try_send(sock, m)
-                elif req == UPDATE_REQ:
-                    idx = indices[sock]
-                    res = try_recv(sock, CURSOR_LEN)
-                    if res is None:
-                        continue
-                    cursors[indices[sock]] = res
-                    cpos = clients[sock]
-                    try_send(sock, pack_update_res(len(moves) - cpos, len(cursors) - 1))
-                    while cpos < len(moves):
-                        try_send(sock, moves[cpos])
-                        cpos += 1
-                    clients[sock] = cpos
-                    for i, c in cursors.items():
-                        if i != idx:
-                            try_send(sock, c)
-                elif req == MOVE_REQ:
-                    res = try_recv(sock, MOVE_LEN)
-                    if res is None:
-                        continue
-                    moves.append(res)
-                elif req == bytes():
-                    print("Server: Client disconnected.")
-                    client_disconnect(sock)
+async def handle_client(room, reader, writer):
+    writer.transport.set_write_buffer_limits(high=WRITE_HIGH_WATER)
+    # clients that never say hello are the released client, which speaks version 0
+    version = 0
+    idx = room.next_idx
+    room.next_idx += 1
+    room.join(idx)
+    print("Server: Client connected.")
+
+    try:
+        while True:
+            req = await reader.read(REQ_LEN)
+            if req == HELLO_REQ:
+                version = min(unpack_hello(await reader.readexactly(HELLO_LEN))[0],
+                              PROTOCOL_VERSION)
+                await send(writer, pack_hello(version))
+            elif req == IDX_REQ:
+                await send(writer, pack_idx(idx))
+            elif req == IMG_REQ:
+                if version == 0:
+                    await send_legacy_image(writer, room)
+                else:
+                    offset = unpack_img_req(await reader.readexactly(IMG_REQ_LEN))[0]
+                    await send_image(writer, room, offset)
+            elif req == INIT_REQ:
+                # everything up to now is in the snapshot, so the log only matters from here on
+                room.positions[idx] = room.end()
+                if version == 0:
+                    # clients without a hello scatter on their own, so every piece gets a move,
+                    # bottom to top so they stack the same way
+                    moves = [Move(p).pack() for p in sorted(room.puzzle.pieces, key=lambda p: p.z)]
+                    await send(writer, pack_legacy_init_res(len(moves)), *moves)
                 else:
-                    print("Server Error: unknown request type: " + str(req))
-        except socket.error as exc:
-            print("Server: Socket error: " + str(exc))
+                    snapshot = room.snapshot()
+                    await send(writer, pack_init_res(room.puzzle.seed, len(snapshot)), *snapshot)
+            elif req == SUBSCRIBE_REQ:
+                room.subscribe(idx, writer)
+                # the rest of the connection is frames
+                await read_frames(room, idx, reader)
+                break
+            elif req == CURSOR_REQ:
+                room.set_cursor(idx, await reader.readexactly(CURSOR_LEN))
+            elif req == UPDATE_REQ:
+                room.set_cursor(idx, await reader.readexactly(CURSOR_LEN))
+                moves = room.moves[room.positions[idx] - room.base:]
+                room.positions[idx] = room.end()
+                room.compact()
+                # legacy clients replace their cursors with whatever comes back, so every reply
+                # carries all of them. send holds this one back if it is far behind
+                cursors = [c for i, c in room.cursors.items() if i != idx]
+                await send(writer, pack_update_res(len(moves), len(cursors)), *moves, *cursors)
+            elif req == MOVE_REQ:
+                room.move(await reader.readexactly(MOVE_LEN))
+            elif req == bytes():
+                break
+            else:
+                print("Server Error: unknown request type: " + str(req))
+    except asyncio.TimeoutError:
+        print("Server: Client stalled.")
+    except (asyncio.IncompleteReadError, ConnectionError) as exc:
+        print("Server: Socket error: " + str(exc))
+    except ValueError as exc:
+        print("Server Error: " + str(exc))
+    finally:
+        print("Server: Client disconnected.")
+        room.leave(idx)
+        writer.close()
+
+
+async def tick(room):
+    next_tick = time.monotonic()
+    while True:
+        next_tick += TICK_INTERVAL
+        await asyncio.sleep(max(0, next_tick - time.monotonic()))
+        room.tick()
+
+
+async def serve(port, room):
+    server = await asyncio.start_server(partial(handle_client, room), "0.0.0.0", port,
+                                        backlog=32)
+    ticker = asyncio.create_task(tick(room))
+    async with server:
+        await server.serve_forever()
+    ticker.cancel()
+
+
+def encode_image(img, img_format):
+    f = io.BytesIO()
+    try:
+        img.save(f, img_format, quality=IMG_QUALITY)
+    except OSError:
+        # formats without an alpha channel
+        f = io.BytesIO()
+        img.convert('RGB').save(f, img_format, quality=IMG_QUALITY)
+    return f.getvalue()
+
+
+def encode_bands(img, img_format):
+    w, h = img.size
+    chunks = [pack_img_info(w, h)]
+    for y in range(0, h, IMG_BAND_ROWS):
+        band = encode_image(img.crop((0, y, w, min(h, y + IMG_BAND_ROWS))), img_format)
+        chunks += [pack_band(y, len(band)), band]
+    return b"".join(chunks)
+
+
+def run(port, img_path, W, H, img_format=None):
+    img = Image.open(img_path)
+    puzzle = Puzzle(img, int(W), int(H), lazy=True, cut_ahead=False)
+    if img_format is None:
+        # bands can't be cut out of an encoded file, so they keep the file's format if they can.
+        # that re-encodes a JPEG or WEBP with a little loss, but lossless bands of a photo come
+        # out several times bigger than the file it was sent as
+        img_format = img.format if img.format in ("JPEG", "WEBP") else "PNG"
+    # encoding a big image takes seconds, which nobody needs to wait for until the first join
+    img_bands = ThreadPoolExecutor(1).submit(encode_bands, Image.open(img_path), img_format)
+    room = Room(puzzle, img_bands, W, H)
+    asyncio.run(serve(port, room))
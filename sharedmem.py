@@ -0,0 +1,113 @@
+import ctypes
+import multiprocessing as mp
+import time
+
+from common import Cursor, CURSOR_LEN
+
+
+MAX_CURSORS = 256
+# a used byte in front of each packed cursor
+CURSOR_SLOT_LEN = 1 + CURSOR_LEN
+
+
+class Ring():
+    # a queue of fixed-size records in shared memory for exactly one producer and one consumer.
+    # the producer only ever writes tail and the consumer only head, so neither waits on the
+    # other. both are still read and written under a lock, which is as good as never contended,
+    # for its memory barrier: without one, a CPU with weaker ordering than x86, like arm64, can
+    # let the consumer see the new tail before the record behind it
+    def __init__(self, record_len, capacity):
+        self.record_len = record_len
+        self.capacity = capacity
+        self.buf = mp.RawArray(ctypes.c_ubyte, record_len * capacity)
+        lock = mp.Lock()
+        self.head = mp.Value(ctypes.c_uint64, 0, lock=lock)
+        self.tail = mp.Value(ctypes.c_uint64, 0, lock=lock)
+
+    def put(self, record):
+        # False when the ring is full, the record is not queued then
+        tail = self.tail.value
+        if tail - self.head.value >= self.capacity:
+            return False
+        i = tail % self.capacity * self.record_len
+        memoryview(self.buf).cast('B')[i:i + self.record_len] = record
+        # the record has to be in before the consumer can see the new tail
+        self.tail.value = tail + 1
+        return True
+
+    def get(self):
+        head = self.head.value
+        if head == self.tail.value:
+            return None
+        i = head % self.capacity * self.record_len
+        record = bytes(memoryview(self.buf).cast('B')[i:i + self.record_len])
+        self.head.value = head + 1
+        return record
+
+
+class SharedBlock():
+    # a block of shared bytes with one writer and any number of readers, behind a sequence lock:
+    # the sequence number is odd while the writer is at it, so a reader that saw it odd or saw it
+    # change while copying reads again. the sequence number is behind a lock for the same memory
+    # barrier as a Ring's tail
+    def __init__(self, size):
+        self.buf = mp.RawArray(ctypes.c_ubyte, size)
+        self.seq = mp.Value(ctypes.c_uint64, 0, lock=mp.Lock())
+
+    def write(self, updates):
+        # (offset, data) pairs, all published at once
+        seq = self.seq.value
+        self.seq.value = seq + 1
+        view = memoryview(self.buf).cast('B')
+        for offset, data in updates:
+            view[offset:offset + len(data)] = data
+        self.seq.value = seq + 2
+
+    def read(self):
+        view = memoryview(self.buf).cast('B')
+        while True:
+            seq = self.seq.value
+            if seq % 2 == 0:
+                data = bytes(view)
+                if self.seq.value == seq:
+                    return seq, data
+            time.sleep(0)
+
+
+class CursorTable():
+    # the other players' cursors, written by the network process and read straight from shared
+    # memory by the render loop. each cursor keeps its slot until it leaves
+    def __init__(self, slots=MAX_CURSORS):
+        self.block = SharedBlock(slots * CURSOR_SLOT_LEN)
+        # writer side: cursor idx -> slot
+        self.slots = {}
+        self.free = list(reversed(range(slots)))
+        # reader side: the cursors as of sequence number self.seq
+        self.seq = None
+        self.cursors = []
+
+    def update(self, changed, gone):
+        # changed maps cursor idx -> packed cursor, cursors past the last free slot aren't shown
+        updates = []
+        for idx in gone:
+            slot = self.slots.pop(idx, None)
+            if slot is not None:
+                self.free.append(slot)
+                updates.append((slot * CURSOR_SLOT_LEN, b"\0"))
+        for idx, packed in changed.items():
+            slot = self.slots.get(idx)
+            if slot is None:
+                if not self.free:
+                    continue
+                slot = self.slots[idx] = self.free.pop()
+            updates.append((slot * CURSOR_SLOT_LEN, b"\1" + packed))
+        if updates:
+            self.block.write(updates)
+
+    def read(self):
+        # only copies the table when the writer has been at it since the last read
+        if self.block.seq.value != self.seq:
+            self.seq, data = self.block.read()
+            self.cursors = [Cursor.unpack(data[i + 1:i + CURSOR_SLOT_LEN])
+                            for i in range(0, len(data), CURSOR_SLOT_LEN) if data[i]]
+        return self.cursors
@@ -0,0 +1,16 @@
+from puzzle import Piece
+
+
+def make_piece(row=0, col=0):
+    return Piece(Piece.MID, row, col, (10, 10), 2, 2)
+
+
+def test_group_contains_none():
+    group = make_piece().group
+    assert None not in group
+
+
+def test_group_contains_members_only():
+    piece, other = make_piece(), make_piece(0, 1)
+    assert piece in piece.group
+    assert other not in piece.group